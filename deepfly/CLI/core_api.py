@@ -12,7 +12,9 @@ import argparse, os.path
 import logging
 import re
 from pathlib import Path
-from deepfly.pose2d.drosophila import main as pose2d_main
+import torch
+from deepfly.pose2d.drosophila import main as pose2d_main, create_model
+from deepfly.pose2d.export import export_model
 from deepfly import pose2d
 from ..GUI.Config import config
 from ..GUI.util.os_util import get_max_img_id, write_camera_order, read_calib, read_camera_order
@@ -50,6 +52,40 @@ def setup(input_folder, camera_ids, num_images_max):
     _save_camera_ordering(args)
     return args
 
+def set_inference_options(setup_data, device="auto", num_threads=0, channels_last=False, precision="fp32", exported=None,
+                          exit_stack=None, exit_tol=None):
+    """ Selects the device and the precision used by pose_estimation,
+        optionally an exported network to run instead of the checkpoint,
+        and the early exit of the network (see HourglassNet.forward).
+    """
+    setup_data.exit_stack = exit_stack
+    setup_data.exit_tol = exit_tol
+    setup_data.device = device
+    setup_data.num_threads = num_threads
+    setup_data.channels_last = channels_last
+    setup_data.precision = precision
+    setup_data.exported = exported
+    return setup_data
+
+
+def export_network(output_path, fmt="torchscript", checkpoint=None, num_stacks=None):
+    """ Writes an inference-only copy of the pose2d network, see pose2d/export.py
+        If num_stacks is set, the exported network only runs the first num_stacks stacks.
+    """
+    args = pose2d.ArgParse.create_parser().parse_args([])
+    if checkpoint is not None:
+        args.resume = checkpoint
+    model = create_model(args, torch.device("cpu"), inference=True)
+    mean = torch.load(config["mean"], map_location="cpu")["mean"]
+    meta = {
+        "image_shape": list(args.img_res),
+        "heatmap_shape": list(args.hm_res),
+        "num_classes": args.num_classes,
+        "num_stacks": args.stacks if num_stacks is None else min(num_stacks, args.stacks),
+    }
+    return export_model(model, mean, output_path, meta, fmt)
+
+
 def pose_estimation(setup_data):
     return pose2d_main(setup_data)
 
@@ -208,10 +244,10 @@ def _make_pose3d_video(args):
         camNetAll, camNetLeft, camNetRight = _getCamNets(args)
 
         camNetLeft.triangulate()
-        camNetLeft.bundle_adjust(cam_id_list=(0,1,2), unique=False, prior=True)
+        camNetLeft.bundle_adjust(cam_id_list=(0,1,2), unique=False, prior=True, max_points=config["calib_num_points"])
         
         camNetRight.triangulate()
-        camNetRight.bundle_adjust(cam_id_list=(0,1,2), unique=False, prior=True)
+        camNetRight.bundle_adjust(cam_id_list=(0,1,2), unique=False, prior=True, max_points=config["calib_num_points"])
 
         camNetAll.triangulate()
         camNetAll.points3d_m = procrustes_seperate(camNetAll.points3d_m)
@@ -0,0 +1,57 @@
+import argparse
+from logging import getLogger
+from . import core_api
+from .main import setup_logger
+
+
+def main():
+    args = parse_cli_args()
+    setup_logger(args)
+
+    meta = core_api.export_network(args.output, fmt=args.format, checkpoint=args.checkpoint, num_stacks=args.exit_stack)
+    getLogger('df3d').info(f'Exported network to {args.output}: {meta}')
+    return 0
+
+
+def parse_cli_args():
+    parser = argparse.ArgumentParser(
+        description = "Export the DeepFly3D pose estimation network for inference"
+    )
+    parser.add_argument(
+        "-v", "--verbose",
+        help="Enable info output",
+        action='store_true'
+    )
+    parser.add_argument(
+        "-vv", "--verbose2",
+        help="Enable debug output",
+        action='store_true'
+    )
+    parser.add_argument(
+        "output",
+        help="Path of the exported network. Its shapes are saved next to it, in OUTPUT.json",
+        metavar="OUTPUT"
+    )
+    parser.add_argument(
+        "--format",
+        help="torchscript (default) or onnx, onnx needs onnxruntime to run.",
+        default="torchscript",
+        choices=["torchscript", "onnx"],
+    )
+    parser.add_argument(
+        "--exit-stack",
+        help="Export only the first N stacks of the network. Default: all.",
+        default=None,
+        type=int,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="Training checkpoint to export. Default: the checkpoint used by df3d-cli.",
+        default=None,
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -105,6 +105,48 @@ def parse_cli_args():
         help="Skip pose estimation",
         action='store_true'
     )
+    parser.add_argument(
+        "--device",
+        help="Device running pose estimation. Default: cuda when available, cpu otherwise.",
+        default="auto",
+        choices=["auto", "cpu", "cuda"],
+    )
+    parser.add_argument(
+        "--num-threads",
+        help="Number of cpu threads used by pose estimation. Default: let torch decide.",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--channels-last",
+        help="Use the channels_last memory format for pose estimation, often faster on cpu.",
+        action='store_true'
+    )
+    parser.add_argument(
+        "--model",
+        help="Exported network to run instead of the checkpoint, see df3d-export.",
+        default=None,
+    )
+    parser.add_argument(
+        "--exit-stack",
+        help="Run only the first N stacks of the pose estimation network, faster but less accurate. Default: all.",
+        default=None,
+        type=int,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--exit-tol",
+        help="Stop the pose estimation network once the heatmap peaks of consecutive stacks move at most PX heatmap pixels. "
+        "Decided for each batch, so results depend on the batch size. Disabled when running on several GPUs.",
+        default=None,
+        type=float,
+        metavar="PX",
+    )
+    parser.add_argument(
+        "--bf16",
+        help="Run pose estimation in bfloat16 precision.",
+        action='store_true'
+    )
     return parser.parse_args()
 
 
@@ -175,6 +217,16 @@ def run(args):
     
     getLogger('df3d').info(f'{Style.BRIGHT}Working in {args.input_folder}{Style.RESET_ALL}')
     setup_data = core_api.setup(args.input_folder, args.camera_ids, args.num_images_max)
+    core_api.set_inference_options(
+        setup_data,
+        device=args.device,
+        num_threads=args.num_threads,
+        channels_last=args.channels_last,
+        precision="bf16" if args.bf16 else "fp32",
+        exported=args.model,
+        exit_stack=args.exit_stack,
+        exit_tol=args.exit_tol,
+    )
 
     if not args.skip_estimation:
         core_api.pose_estimation(setup_data)
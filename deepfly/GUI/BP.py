@@ -4,7 +4,11 @@ import numpy as np
 
 from .Config import config
 from .Camera import Camera
-from .util.optim_util import project_on_last, energy_drosoph
+from .util.optim_util import (
+    energy_drosoph_batch,
+    project_cameras,
+    triangulate_batch,
+)
 from .Config import config
 
 class LegBP:
@@ -18,7 +22,15 @@ class LegBP:
         prior=None,
         upper_bound=config["upper_bound"],
         image_shape=config["image_shape"],
+        seed=None,
+        max_candid=config["max_candid"],
     ):
+        """
+        seed: optional dict from joint id to num_cameras x 2 normalized points, usually the
+        solution of the previous image projected on the cameras. Only the peak closest to the seed
+        is kept in each camera, seed_found is False if a camera seeing the joint has no peak nearby.
+        max_candid: number of candidates kept for each joint, by lowest unary cost, None to keep all of them
+        """
         self.camera_network = camera_network
         self.cam_list = self.camera_network.cam_list
         self.img_id = img_id
@@ -26,26 +38,33 @@ class LegBP:
         self.bone_param = bone_param
         self.num_peak = num_peak
         self.upper_bound = upper_bound
+        self.max_candid = max_candid
         self.cam_id_list = [cam.cam_id for cam in self.camera_network]
 
         self.image_res = image_shape
         self.jointbp = [JointBP(j_id) for j_id in j_id_list]
         self.prior = prior
-        self.generate_proposals(self.num_peak, prior)
+        self.seed = seed
+        self.seed_found = True
 
         self.alpha_reproj = config["alpha_reproj"]
         self.alpha_heatmap = config["alpha_heatmap"]
         self.alpha_bone = config["alpha_bone"]
 
+        self.generate_proposals(self.num_peak, prior)
+
     def __getitem__(self, i):
         return self.jointbp[i]
 
     def generate_proposals(self, num_peak, prior=None):
+        cam_list = self.camera_network.cam_list
         for j in self.jointbp:
-            cam_id_list_seeing_joint = [cam_id for cam_id in self.cam_id_list if config["skeleton"].camera_see_joint(cam_id, j.j_id)]
-            p2d_list = []
+            camera_see_joint = config["skeleton"].camera_see_joint_arr[:, j.j_id]
+            cam_id_list_seeing_joint = [cam_id for cam_id in self.cam_id_list if camera_see_joint[cam_id]]
             # find 2d proposals for a given joint for each camera, by taking local maximums
-            for cam in self.camera_network:
+            hm_list = [np.squeeze(cam.get_heatmap(self.img_id, j.j_id)) for cam in cam_list]
+            p2d_list = []
+            for hm in hm_list:
                 min_distance = 1
                 threshold_abs = 0.0
                 '''
@@ -61,7 +80,7 @@ class LegBP:
 
                 p2d_list.append(
                     Camera.hm_to_pred(
-                        np.squeeze(cam.get_heatmap(self.img_id, j.j_id)),
+                        hm,
                         num_pred=num_peak,
                         min_distance=min_distance,
                         threshold_abs=threshold_abs,
@@ -69,6 +88,9 @@ class LegBP:
                     )
                 )
 
+            if self.seed is not None:
+                self.seed_proposals(j, p2d_list, hm_list)
+
             # set the priors (user manual correction)
             cams_with_prior = []
             if prior is not None:
@@ -79,128 +101,172 @@ class LegBP:
                             pts
                         ]  # we remove all the other heatmap proposals
                         cams_with_prior.append(cam_id)
+            p2d_list = [np.array(p2d, dtype=float).reshape(-1, 2) for p2d in p2d_list]
 
-            # find 3d proposals by triangulating with all the visible cameras
-            for p2d_prop in list(itertools.product(*p2d_list)):
-                if j.get_num_candid() > self.upper_bound:
-                    # print("Hit upper bound of 3d proposals {}".format(self.upper_bound))
-                    continue
-
-                p2d_list_iter = list()
-                cam_list_iter = list()
-                for cam, p2d in zip(self.camera_network.cam_list, p2d_prop):
-                    if config["skeleton"].camera_see_joint(cam.cam_id, j.j_id):
-                        p2d_list_iter.append(p2d)
-                        cam_list_iter.append(cam)
-                p2d_list_iter = np.array(p2d_list_iter).reshape(-1, 2)
-                p3d, err_proj, prob_hm, _ = energy_drosoph(
-                    cam_list_iter, self.img_id, j.j_id, p2d_list_iter, None, None
-                )
-                prob_hm += len(
-                    [
-                        cam_id
-                        for cam_id in cams_with_prior
-                        if config["skeleton"].camera_see_joint(cam_id, j.j_id)
-                    ]
-                )
-                # we give p2d_prop instead of p2d, as we need to set 2d values also for invisible points.
-                j.add_candid(p3d, p2d_prop, err_proj, prob_hm)
+            # find 3d proposals by triangulating with all the visible cameras,
+            # only the first upper_bound + 1 combinations are kept
+            visible = [idx for idx, cam in enumerate(cam_list) if camera_see_joint[cam.cam_id]]
+            p2d_prop = self.product_proposals(p2d_list, self.upper_bound + 1)
+            p3d, err_proj, prob_hm = energy_drosoph_batch(
+                [cam_list[idx] for idx in visible],
+                [hm_list[idx] for idx in visible],
+                p2d_prop[:, visible],
+            )
+            prob_hm += len(
+                [
+                    cam_id
+                    for cam_id in cams_with_prior
+                    if camera_see_joint[cam_id]
+                ]
+            )
+            # we give p2d_prop instead of p2d, as we need to set 2d values also for invisible points.
+            j.add_candid_batch(p3d, p2d_prop, err_proj, prob_hm)
+
+            # with a single seeded proposal per camera, triplets would repeat the candidate above
+            if self.seed is not None:
+                continue
 
-            # for every triplet of cameras seeing the point
+            # for every triplet of cameras seeing the point, candidates of all triplets are evaluated at once
+            p2d_prop_list, num_prior_list = list(), list()
             for camid_x, camid_y, camid_z in itertools.permutations(
                 cam_id_list_seeing_joint, 3
             ):
-                cam_index_x, cam_index_y, cam_index_z = (
+                cam_index = [
                     self.cam_id_list.index(camid_x),
                     self.cam_id_list.index(camid_y),
                     self.cam_id_list.index(camid_z),
-                )
-                cam_x, cam_y, cam_z = (
-                    self.cam_list[cam_index_x],
-                    self.cam_list[cam_index_y],
-                    self.cam_list[cam_index_z],
-                )
-                # iterate over all combinations of 2d proposals
-                for p2d_x, p2d_y, p2d_z in list(
-                    itertools.product(
-                        *[
-                            p2d_list[cam_index_x],
-                            p2d_list[cam_index_y],
-                            p2d_list[cam_index_z],
-                        ]
+                ]
+                # all combinations of 2d proposals
+                p2d_triplet = self.product_proposals([p2d_list[idx] for idx in cam_index])
+                p2d_prop = np.zeros((p2d_triplet.shape[0], len(cam_list), 2))
+                p2d_prop[:, cam_index] = p2d_triplet
+
+                # for all remaining cameras triangulate and project to find 2d points
+                cam_index_project = [
+                    idx for idx in range(len(self.cam_id_list)) if idx not in cam_index
+                ]
+                if cam_index_project:
+                    p3d = triangulate_batch(
+                        [cam_list[idx] for idx in cam_index], p2d_triplet * self.image_res
                     )
-                ):
-                    p2d_list_iter = [None] * len(self.cam_id_list)
-                    p2d_list_iter[cam_index_x] = p2d_x
-                    p2d_list_iter[cam_index_y] = p2d_y
-                    p2d_list_iter[cam_index_z] = p2d_z
-
-                    # for all remaining cameras triangulate and project to find 2d points
-                    for cam_index_project in [
-                        cam_index
-                        for cam_index in range(len(self.cam_id_list))
-                        if cam_index not in [cam_index_x, cam_index_y, cam_index_z]
-                    ]:
-                        p2d_list_iter[cam_index_project] = (
-                            project_on_last(
-                                [cam_x, cam_y, cam_z, self.cam_list[cam_index_project]],
-                                np.array([p2d_x, p2d_y, p2d_z]).reshape(-1, 2)
-                                * self.image_res,
-                            )
-                            / self.image_res
-                        )
-                    p2d_list_iter = np.array(p2d_list_iter).reshape(-1, 2)
-                    p3d, err_proj, prob_hm, _ = energy_drosoph(
-                        self.camera_network.cam_list,
-                        self.img_id,
-                        j.j_id,
-                        p2d_list_iter,
-                        None,
-                        None,
+                    p2d_prop[:, cam_index_project] = (
+                        project_cameras([cam_list[idx] for idx in cam_index_project], p3d)
+                        / self.image_res
                     )
-                    prob_hm += len(
-                        [
-                            cam_id
-                            for cam_id in cams_with_prior
-                            if (
-                                config["skeleton"].camera_see_joint(cam_id, j.j_id)
-                                and cam_id in [camid_x, camid_y, camid_z]
-                            )
-                        ]
+
+                p2d_prop_list.append(p2d_prop)
+                num_prior_list.append(
+                    np.full(
+                        p2d_prop.shape[0],
+                        len(
+                            [
+                                cam_id
+                                for cam_id in cams_with_prior
+                                if (
+                                    camera_see_joint[cam_id]
+                                    and cam_id in [camid_x, camid_y, camid_z]
+                                )
+                            ]
+                        ),
                     )
+                )
+
+            if p2d_prop_list:
+                p2d_prop = np.concatenate(p2d_prop_list)
+                p3d, err_proj, prob_hm = energy_drosoph_batch(cam_list, hm_list, p2d_prop)
+                prob_hm += np.concatenate(num_prior_list)
+                j.add_candid_batch(p3d, p2d_prop, err_proj, prob_hm)
 
-                    j.add_candid(p3d, p2d_list_iter, err_proj, prob_hm)
+            if self.max_candid is not None and j.get_num_candid() > self.max_candid:
+                j.select(np.argpartition(self.m_j(j), self.max_candid - 1)[: self.max_candid])
 
-    def propagate(self):  # start from the leaf, calculate belief for each candid
-        for c in self.jointbp[-1].candid_list:  # the only leaf
-            c.belief = 1
+    def seed_proposals(
+        self,
+        j,
+        p2d_list,
+        hm_list,
+        radius=config["bp_temporal_radius"],
+        min_score=config["bp_temporal_min_score"],
+    ):
+        """
+        Replaces the proposals of each camera by the peak closest to the seed of joint j,
+        if it is within radius heatmap pixels and its heatmap value is at least min_score.
+        Otherwise the seed itself is the only proposal.
+        """
+        camera_see_joint = config["skeleton"].camera_see_joint_arr[:, j.j_id]
+        for cam_index, (cam, hm) in enumerate(zip(self.cam_list, hm_list)):
+            seed = self.seed[j.j_id][cam_index]
+            p2d = np.array(p2d_list[cam_index], dtype=float).reshape(-1, 2)
+            dist = np.linalg.norm((p2d - seed) * [hm.shape[1], hm.shape[0]], axis=1)
+            row = np.clip(np.rint(p2d[:, 1] * hm.shape[0]).astype(int), 0, hm.shape[0] - 1)
+            col = np.clip(np.rint(p2d[:, 0] * hm.shape[1]).astype(int), 0, hm.shape[1] - 1)
+            near = (dist <= radius) & (hm[row, col] >= min_score)
+            if np.any(near):
+                p2d_list[cam_index] = p2d[near][[np.argmin(dist[near])]]
+            else:
+                p2d_list[cam_index] = seed[np.newaxis]
+                if camera_see_joint[cam.cam_id]:
+                    self.seed_found = False
+
+    def max_err_proj(self):
+        """Largest reprojection error of the solution, after solve"""
+        return max(j.err_proj[j.argmin] for j in self.jointbp)
+
+    @staticmethod
+    def product_proposals(p2d_list, max_num=None):
+        """
+        Rows of itertools.product(*p2d_list), one 2d proposal per camera, as a n x len(p2d_list) x 2 array.
+        Only the first max_num combinations are returned if max_num is set.
+        """
+        size = [p2d.shape[0] for p2d in p2d_list]
+        num = int(np.prod(size)) if max_num is None else min(int(np.prod(size)), max_num)
+        idx = np.unravel_index(np.arange(num), size)
+        return np.stack([p2d[i] for p2d, i in zip(p2d_list, idx)], axis=1)
+
+    def propagate(self, chunk_size=256):  # start from the leaf, calculate belief for each candid
+        """Beliefs of the parent candidates are computed for chunk_size parents at a time"""
+        self.jointbp[-1].belief[:] = 1  # the only leaf
         for idx in range(
             len(self.j_id_list) - 1, 0, -1
         ):  # finish at the root (at 0) (excluding)
-            for cand_p in self.jointbp[idx - 1].candid_list:
-                j_c = self.jointbp[idx]
-                cand_p.belief = min(
-                    [self.B_j(cand_c, cand_p) for cand_c in j_c.candid_list]
-                )
+            j_p, j_c = self.jointbp[idx - 1], self.jointbp[idx]
+            j_p.belief = np.concatenate(
+                [np.zeros(0)]
+                + [
+                    np.min(self.B_j(j_c, j_p, slice(start, start + chunk_size)), axis=0)
+                    for start in range(0, j_p.get_num_candid(), chunk_size)
+                ]
+            )
 
-    def B_j(self, cand_c, cand_p):  # function of parent node, cost function
-        return (
-            self.m_j(cand_c)
+    def B_j(self, j_c, j_p, p_idx=None):  # function of parent node, cost function
+        """
+        Cost of every child candidate of j_c for the parent candidates of j_p,
+        num_child x num_parent array, for the parents in the slice p_idx if set,
+        or num_child array if p_idx is the index of one parent candidate
+        """
+        p3d_p = j_p.p3d if p_idx is None else j_p.p3d[p_idx].reshape(-1, 3)
+        cost = (
+            self.m_j(j_c)[:, np.newaxis]
             + self.alpha_bone
-            * (
-                1
-                - self.d_ij(
-                    cand_c.p3d, cand_p.p3d, self.bone_param[cand_p.j_id], cand_p.j_id
-                )
-            )
-            + cand_c.belief
+            * (1 - self.d_ij(j_c.p3d, p3d_p, self.bone_param[j_p.j_id], j_p.j_id))
+            + j_c.belief[:, np.newaxis]
         )
+        return cost[:, 0] if isinstance(p_idx, (int, np.integer)) else cost
 
     def d_ij(self, p3d_c, p3d_p, param, joint_id):
+        """Bone length probability of all the child and parent pairs, len(p3d_c) x len(p3d_p) array"""
         mu, sig = param
         if np.isnan(mu) or np.isnan(sig):
             raise Exception
-        dist = np.linalg.norm((p3d_c - p3d_p))
+        # |c - p|^2 = |c|^2 + |p|^2 - 2 c.p, without a len(p3d_c) x len(p3d_p) x 3 temporary
+        dist = np.sqrt(
+            np.maximum(
+                np.sum(p3d_c ** 2, axis=1)[:, np.newaxis]
+                + np.sum(p3d_p ** 2, axis=1)[np.newaxis, :]
+                - 2 * p3d_c.dot(p3d_p.T),
+                0,
+            )
+        )
         return np.exp(-np.power(dist - mu, 2.0) / (2 * np.power(sig, 2.0)))
 
         # if joint tarsus tip, then penalize less for shrinking
@@ -214,40 +280,73 @@ class LegBP:
                 return np.exp(-np.power(dist - mu, 2.0) / (2 * np.power(sig * 3, 2.0)))
         '''
 
-    def m_j(self, cand):
-        return self.alpha_reproj * cand.err_proj + self.alpha_heatmap * (
-            1 - cand.prob_hm
+    def m_j(self, j):
+        """Unary cost of every candidate of j"""
+        return self.alpha_reproj * j.err_proj + self.alpha_heatmap * (
+            1 - j.prob_hm
         )
 
     def solve(self):  # start from the root, set the joint with the largest belief
         root_j = self.jointbp[0]
-        belief_list = [
-            self.m_j(candid) + candid.belief for candid in root_j.candid_list
-        ]
-        root_j.argmin = np.argmin(belief_list)
+        root_j.argmin = np.argmin(self.m_j(root_j) + root_j.belief)
 
-        cand_p = root_j.candid_list[root_j.argmin]
         for idx in range(1, len(self.j_id_list)):  # exclude root, already solved
+            j_p = self.jointbp[idx - 1]
             self.jointbp[idx].argmin = np.argmin(
-                [self.B_j(cand_c, cand_p) for cand_c in self.jointbp[idx].candid_list]
+                self.B_j(self.jointbp[idx], j_p, j_p.argmin)
             )
-            cand_p = self.jointbp[idx].candid_list[self.jointbp[idx].argmin]
 
 
 class JointBP:
+    """Candidates of one joint, stored as arrays with one row per candidate"""
+
     def __init__(self, j_id):
         self.j_id = j_id
-        self.candid_list = list()
+        self.p3d = np.zeros((0, 3))
+        self.p2d = None
+        self.err_proj = np.zeros(0)
+        self.prob_hm = np.zeros(0)
+        self.belief = np.zeros(0)
         self.argmin = None
 
     def __getitem__(self, i):
-        return self.candid_list[i]
+        return Candid(
+            self.j_id,
+            self.p3d[i],
+            self.p2d[i],
+            self.err_proj[i],
+            self.prob_hm[i],
+            self.belief[i],
+        )
 
     def get_num_candid(self):
-        return len(self.candid_list)
+        return self.p3d.shape[0]
+
+    def select(self, idx):
+        """Keeps only the candidates idx"""
+        self.p3d = self.p3d[idx]
+        self.p2d = self.p2d[idx]
+        self.err_proj = self.err_proj[idx]
+        self.prob_hm = self.prob_hm[idx]
+        self.belief = self.belief[idx]
 
     def add_candid(self, p3d, p2d, err_proj, prob_hm, belief=1):
-        self.candid_list.append(Candid(self.j_id, p3d, p2d, err_proj, prob_hm))
+        self.add_candid_batch(
+            np.reshape(p3d, (1, 3)),
+            np.asarray(p2d, dtype=float)[np.newaxis],
+            [err_proj],
+            [prob_hm],
+            belief,
+        )
+
+    def add_candid_batch(self, p3d, p2d, err_proj, prob_hm, belief=1):
+        """Adds one candidate for each row of the arrays"""
+        p2d = np.asarray(p2d, dtype=float)
+        self.p3d = np.concatenate([self.p3d, np.reshape(p3d, (-1, 3))])
+        self.p2d = p2d if self.p2d is None else np.concatenate([self.p2d, p2d])
+        self.err_proj = np.concatenate([self.err_proj, err_proj])
+        self.prob_hm = np.concatenate([self.prob_hm, prob_hm])
+        self.belief = np.concatenate([self.belief, np.full(len(err_proj), belief, dtype=float)])
 
 
 class Candid:
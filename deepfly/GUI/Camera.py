@@ -26,6 +26,7 @@ class Camera:
         self.cam_id_read = cid_read if cid_read is not None else cid
         self.json_path = json_path
         self.image_folder = image_folder
+        self.version = 0  # increased when the 2d points or the calibration are set
         self.points2d = points2d  # pixel coordinates, not normalized
         if json_path is not None:  # to read annotations from
             self.__parse_json(json_path, num_images=num_images)
@@ -70,31 +71,37 @@ class Camera:
         self.mask_unique = None
 
     def set_intrinsic(self, intrinsic):
+        self.version += 1
         self.intr = intrinsic
         self.focal_length_x = intrinsic[0, 0]
         self.focal_length_y = intrinsic[1, 1]
         self.P = Camera.calc_projection_matrix(self.R, self.tvec, self.intr)
 
     def set_R(self, R, set_rvec=True):
+        self.version += 1
         self.R = R
         if set_rvec:
             self.set_rvec(cv2.Rodrigues(R)[0], set_R=False)
         self.P = Camera.calc_projection_matrix(self.R, self.tvec, self.intr)
 
     def set_rvec(self, rvec, set_R=True):
+        self.version += 1
         self.rvec = np.squeeze(rvec)
         if set_R:
             self.set_R(cv2.Rodrigues(rvec)[0], set_rvec=False)
         self.P = Camera.calc_projection_matrix(self.R, self.tvec, self.intr)
 
     def set_tvec(self, tvec):
+        self.version += 1
         self.tvec = tvec.astype(np.float)
         self.P = Camera.calc_projection_matrix(self.R, self.tvec, self.intr)
 
     def set_distort(self, distort):
+        self.version += 1
         self.distort = np.squeeze(distort)
 
     def set_focal_length(self, fx, fy):
+        self.version += 1
         self.focal_length_x = fx
         self.focal_length_y = fy
         self.intr[0, 0] = fx
@@ -124,9 +131,36 @@ class Camera:
     OPERATIONS
     """
 
+    @property
+    def points2d(self):
+        return self._points2d
+
+    @points2d.setter
+    def points2d(self, points2d):
+        self._points2d = points2d
+        self.version += 1
+
+    def invalidate(self):
+        """To call after points2d or the calibration are edited in place, see CameraNetwork.reprojection_error_all"""
+        self.version += 1
+
     def __getitem__(self, key):
         return self.points2d[key].reshape(-1, 2)
 
+    def __getstate__(self):
+        # memory-mapped heatmaps are reopened by the receiving process instead of being copied
+        state = self.__dict__.copy()
+        if isinstance(self.hm, np.memmap) and self.hm.filename is not None:
+            state["hm"] = ("memmap", self.hm.filename, self.hm.dtype, self.hm.shape, self.hm.offset)
+        return state
+
+    def __setstate__(self, state):
+        hm = state.get("hm")
+        if isinstance(hm, tuple) and hm[0] == "memmap":
+            _, filename, dtype, shape, offset = hm
+            state["hm"] = np.memmap(filename, dtype=dtype, mode="r", shape=shape, offset=offset)
+        self.__dict__.update(state)
+
     def calc_mask_unique(self, thr=3):
         m = np.zeros(shape=self.points2d.shape, dtype=np.bool)
         size_list = []
@@ -199,11 +233,6 @@ class Camera:
             if self.hm is None:
                 # print("Trying to read nonexisting heatmap")
                 return np.zeros(shape=(len(j_id), 64, 128), dtype=float)
-            for j in j_id:
-                if not config["skeleton"].camera_see_joint(self.cam_id, j):
-                    # print("Trying to read heatmap from camera {} point {}".format(self.cam_id, j))
-                    pass
-
             if self.cam_id > 3:
                 j_id = [(j % (config["skeleton"].num_joints // 2)) for j in j_id]
             if self.cam_id < 3 or self.cam_id > 3:
@@ -240,6 +269,39 @@ class Camera:
             else:
                 return self.hm[self.cam_id_read, img_id, :]
 
+    def get_heatmap_confidence(self, img_id_offset=0):
+        """
+        Heatmap value under each 2d prediction, used as the confidence of the detection.
+        img_id_offset: image id of the first row of points2d, when points2d only holds a range of the images
+        Returns num_images x num_joints array, ones when the heatmaps are not loaded.
+        """
+        num_images, num_joints = self.points2d.shape[:2]
+        if self.hm is None or isinstance(self.hm, dict):
+            return np.ones((num_images, num_joints), dtype=float)
+
+        img_id, j_id = np.nonzero(
+            np.broadcast_to(
+                config["skeleton"].camera_see_joint_arr[self.cam_id],
+                (num_images, num_joints),
+            )
+        )
+        # heatmap channel and camera storing each joint, see get_heatmap
+        cam_id_read = np.full(j_id.shape, self.cam_id_read)
+        j_id_read = j_id
+        if "fly" in config["name"]:
+            j_id_read = j_id % config["num_predict"]
+            if self.cam_id == 3:
+                cam_id_read[j_id >= config["num_predict"]] = 7
+
+        hm_shape = self.hm.shape[-2:]
+        pts = self.points2d[img_id, j_id] / config["image_shape"]
+        r = np.clip((pts[:, 1] * hm_shape[0]).astype(int), 0, hm_shape[0] - 1)
+        c = np.clip((pts[:, 0] * hm_shape[1]).astype(int), 0, hm_shape[1] - 1)
+
+        confidence = np.zeros((num_images, num_joints), dtype=float)
+        confidence[img_id, j_id] = self.hm[cam_id_read, img_id + img_id_offset, j_id_read, r, c]
+        return confidence
+
     def get_image(self, img_id, flip=False):
         try:
             image_path = os.path.join(self.image_folder,"camera_{}_img_{:06}.jpg".format(self.cam_id_read, img_id))
@@ -299,11 +361,9 @@ class Camera:
         if zorder is None:
             zorder = config["skeleton"].get_zorder(self.cam_id)
         if draw_joints is None:
-            draw_joints = [
-                j
-                for j in range(config["skeleton"].num_joints)
-                if config["skeleton"].camera_see_joint(self.cam_id, j)
-            ]
+            draw_joints = np.flatnonzero(
+                config["skeleton"].camera_see_joint_arr[self.cam_id]
+            ).tolist()
         pts_tmp = pts.copy()
         if flip_points:
             pts_tmp[pts_tmp > config["image_shape"][0]] = config["image_shape"][0]
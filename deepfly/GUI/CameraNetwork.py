@@ -1,6 +1,8 @@
 import glob
 import os
 import pickle
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 import matplotlib.pyplot as plt
 from scipy.optimize import least_squares
@@ -11,6 +13,8 @@ from .BP import LegBP
 from .Camera import Camera
 from .util.ba_util import *
 from .util.cv_util import *
+from .util.heatmap_util import open_heatmap
+from .util.optim_util import project_cameras
 
 from .util.os_util import read_calib
 
@@ -35,10 +39,12 @@ class CameraNetwork:
         self.folder = image_folder
         self.folder_output = output_folder
         self.dict_name = image_folder
+        self.points3d_version = 0
         self.points3d_m = None
         self.mask_unique = None
         self.mask_prior = None
         self.bone_param = None
+        self.reprojection_error_cache = None  # (inputs version, error), see reprojection_error
 
         self.num_images = num_images
         self.num_joints = num_joints
@@ -71,6 +77,11 @@ class CameraNetwork:
 
             if hm_path is None:
                 heatmap_path_list = glob.glob(os.path.join(self.folder_output, "heatmap*.pkl"))
+                if len(heatmap_path_list) == 0:
+                    # only the local maxima of the heatmaps were kept
+                    heatmap_path_list = [
+                        p for p in glob.glob(os.path.join(self.folder_output, "peaks*")) if os.path.isdir(p)
+                    ]
                 heatmap_path_list.sort(key=os.path.getmtime)
                 heatmap_path_list = heatmap_path_list[::-1]
             else:
@@ -86,12 +97,7 @@ class CameraNetwork:
                         self.heatmap_shape[1],
                     )
                     getLogger('df3d').debug("Heatmap shape: {}".format(shape))
-                    heatmap = np.memmap(
-                        filename=heatmap_path_list[0],
-                        mode="r",
-                        shape=shape,
-                        dtype="float32",
-                    )
+                    heatmap = open_heatmap(heatmap_path_list[0], shape)
                 except BaseException as e:
                     getLogger('df3d').debug(
                         "Cannot read heatmap as memory mapped: {}, {}".format(
@@ -177,16 +183,15 @@ class CameraNetwork:
         return self[0].hm is not None
 
     def calc_mask_prior(self, thr=50):
-        self.mask_prior = np.zeros(self[0].points2d.shape, dtype=bool)
-        for (img_id, joint_id, _), _ in np.ndenumerate(self.mask_prior):
-            l = [
-                np.abs(cam[img_id, joint_id][0][1])
-                for cam in self.cam_list
-                if config["skeleton"].camera_see_joint(cam.cam_id, joint_id)
-            ]
+        # y coordinates of each joint, from the cameras seeing the joint
+        visible = config["skeleton"].camera_see_joint_arr[[cam.cam_id for cam in self.cam_list]]
+        y = np.abs(np.stack([cam.points2d[:, :, 1] for cam in self.cam_list]))
+        y_max = np.max(np.where(visible[:, np.newaxis, :], y, -np.inf), axis=0)
+        y_min = np.min(np.where(visible[:, np.newaxis, :], y, np.inf), axis=0)
 
-            is_aligned = len(l) and ((np.max(l) - np.min(l)) < thr)
-            self.mask_prior[img_id, joint_id, :] = is_aligned
+        is_aligned = np.logical_and(np.any(visible, axis=0), (y_max - y_min) < thr)
+        self.mask_prior = np.zeros(self[0].points2d.shape, dtype=bool)
+        self.mask_prior[:] = is_aligned[:, :, np.newaxis]
 
         getLogger('df3d').debug(
             "Number of points close to prior epipolar line: {}".format(
@@ -199,27 +204,15 @@ class CameraNetwork:
 
         if cam_id_list is None:
             cam_id_list = list(range(self.num_cameras))
-        points2d_shape = self[0].points2d.shape
-        self.points3d_m = np.zeros(
-            shape=(points2d_shape[0], points2d_shape[1], 3), dtype=np.float
-        )
-        data_shape = self.cam_list[0].points2d.shape
-        for img_id in range(data_shape[0]):
-            for j_id in range(data_shape[1]):
-                cam_list_iter = list()
-                points2d_iter = list()
-                for cam in [self.cam_list[cam_idx] for cam_idx in cam_id_list]:
-                    if np.any(cam[img_id, j_id, :] == 0):
-                        continue
-                    if not config["skeleton"].camera_see_joint(cam.cam_id, j_id):
-                        continue
-                    cam_list_iter.append(cam)
-                    points2d_iter.append(cam[img_id, j_id, :])
-
-                if len(cam_list_iter) >= 2:
-                    self.points3d_m[img_id, j_id, :] = triangulate_linear(
-                        cam_list_iter, points2d_iter
-                    )
+        cam_list_iter = [self.cam_list[cam_idx] for cam_idx in cam_id_list]
+
+        # (N, J, C, 2) observations, a camera is used if it sees the joint
+        points2d = np.stack([cam.points2d for cam in cam_list_iter], axis=2)
+        visible = config["skeleton"].camera_see_joint_arr[[cam.cam_id for cam in cam_list_iter]]
+        mask = np.logical_and(np.all(points2d != 0, axis=3), visible.T[np.newaxis])
+
+        proj = np.stack([cam.P for cam in cam_list_iter])
+        self.points3d_m = nview_linear_triangulation_batch(proj, points2d, mask)
 
     def calc_mask_unique(self):
         # mask on points2d where observations are present and unique
@@ -232,28 +225,16 @@ class CameraNetwork:
         )
 
     def solvePnp(self, cam_id, ignore_joint_list=config["skeleton"].ignore_joint_id):
-        points3d_pnp = []
-        points2d_pnp = []
-        data_shape = self.cam_list[0].points2d.shape
-        for img_id in range(data_shape[0]):
-            for j_id in range(data_shape[1]):
-                if not config["skeleton"].camera_see_joint(
-                        cam_id, j_id
-                ):
-                    continue
-                if np.any(
-                        self.cam_list[cam_id][img_id, j_id, :] == 0
-                ):
-                    continue
-                if j_id in ignore_joint_list:
-                    continue
-                if np.any(self.points3d_m[img_id, j_id] == 0):
-                    continue
-                points3d_pnp.append(self.points3d_m[img_id, j_id, :])
-                points2d_pnp.append(self.cam_list[cam_id][img_id][j_id, :])
-
-        objectPoints = np.array(points3d_pnp)
-        imagePoints = np.array(points2d_pnp)
+        points2d = self.cam_list[cam_id].points2d
+        joint_mask = np.logical_and(
+            config["skeleton"].camera_see_joint_arr[cam_id],
+            np.logical_not(np.isin(np.arange(points2d.shape[1]), ignore_joint_list)),
+        )
+        mask = np.logical_and(np.all(points2d != 0, axis=2), np.all(self.points3d_m != 0, axis=2))
+        mask = np.logical_and(mask, joint_mask[np.newaxis, :])
+
+        objectPoints = self.points3d_m[mask]
+        imagePoints = points2d[mask]
 
         getLogger('df3d').debug("objectPoints shape: {}".format(objectPoints.shape))
         if objectPoints.shape[0] > 4:
@@ -273,27 +254,156 @@ class CameraNetwork:
             getLogger('df3d').debug("Skipping PnP, not enough points")
 
     def reprojection_error(self, cam_indices=None, ignore_joint_list=None):
+        """
+        Distance in pixels between the projections of points3d_m and the 2d points of the cameras in cam_indices.
+        returns len(cam_indices) x num_images x num_joints array, nan where the camera does not see the joint,
+        and for the joints in ignore_joint_list
+        """
         if ignore_joint_list is None:
             ignore_joint_list = config["skeleton"].ignore_joint_id
         if cam_indices is None:
             cam_indices = range(len(self.cam_list))
+        cam_indices = list(cam_indices)
 
-        err_list = list()
-        for (img_id, j_id, _), _ in np.ndenumerate(self.points3d_m):
-            p3d = self.points3d_m[img_id, j_id].reshape(1, 3)
-            if j_id in ignore_joint_list:
-                continue
-            for cam in self.cam_list:
-                if not config["skeleton"].camera_see_joint(cam.cam_id, j_id):
-                    continue
-                err_list.append((cam.project(p3d) - cam[img_id, j_id]).ravel())
+        err = self.reprojection_error_all()[cam_indices]
+        err[:, :, np.isin(np.arange(err.shape[2]), ignore_joint_list)] = np.nan
 
-        err_mean = np.mean(np.abs(err_list))
-        getLogger('df3d').debug("Ignore_list {}:  {:.4f}".format(ignore_joint_list, err_mean))
-        return err_list
+        getLogger('df3d').debug(
+            "Ignore_list {}: mean euclidean reprojection error {:.4f}px".format(
+                ignore_joint_list, np.nanmean(err)
+            )
+        )
+        return err
+
+    def reprojection_error_all(self):
+        """
+        reprojection_error of all the cameras and joints, projecting every point once with every camera.
+        The error is kept until points3d_m, the 2d points or the calibration are set again,
+        after editing them in place, call invalidate() on the network or the camera.
+        """
+        assert self.points3d_m is not None
+        key = self.reprojection_error_key()
+        if self.reprojection_error_cache is not None and self.reprojection_error_cache[0] == key:
+            return self.reprojection_error_cache[1].copy()
+
+        num_images, num_joints = self.points3d_m.shape[:2]
+        points3d = self.points3d_m.reshape(-1, 3).astype(float)
+        err = np.full((len(self.cam_list), num_images, num_joints), np.nan)
+        for cam_idx, cam in enumerate(self.cam_list):
+            visible = config["skeleton"].camera_see_joint_arr[cam.cam_id, :num_joints]
+            points2d = cam.project(points3d).reshape(num_images, num_joints, 2)
+            err_cam = np.linalg.norm(points2d - cam.points2d[:num_images, :num_joints], axis=2)
+            err[cam_idx][:, visible] = err_cam[:, visible]
+
+        self.reprojection_error_cache = (key, err)
+        return err.copy()
+
+    def reprojection_error_key(self):
+        """Versions of what reprojection_error depends on, the points and the calibration"""
+        return (self.points3d_version,) + tuple((cam.cam_id, cam.version) for cam in self.cam_list)
+
+    def invalidate(self):
+        """To call after points3d_m is edited in place"""
+        self.points3d_version += 1
+
+    @property
+    def points3d_m(self):
+        return self._points3d_m
+
+    @points3d_m.setter
+    def points3d_m(self, points3d_m):
+        self._points3d_m = points3d_m
+        self.points3d_version += 1
+
+    def __getstate__(self):
+        # the cached reprojection error can be as large as the 2d points of all cameras
+        state = self.__dict__.copy()
+        state["reprojection_error_cache"] = None
+        return state
+
+    def ba_observation_mask(self, cam_list, ignore_joint_list, unique=False):
+        """
+        Observations usable for the bundle adjustment, num_images x num_joints x len(cam_list) bool array
+        """
+        skeleton = config["skeleton"]
+        points2d = np.stack([cam.points2d for cam in cam_list], axis=2)
+        cam_id_arr = np.array([cam.cam_id for cam in cam_list])
+        data_shape = self.points3d_m.shape
+        ignore_joint_mask = np.isin(np.arange(data_shape[1]), ignore_joint_list)
+        mask = np.all(points2d != 0, axis=3)
+        mask &= np.all(self.points3d_m != 0, axis=2)[:, :, np.newaxis]
+        mask &= ~ignore_joint_mask[np.newaxis, :, np.newaxis]
+        mask &= skeleton.camera_see_joint_arr[cam_id_arr].T[np.newaxis]
+        mask &= (cam_id_arr != 3)[np.newaxis, np.newaxis, :]
+        # if prior:
+        #    mask &= self.mask_prior[:, :, 0][:, :, np.newaxis]
+        if unique:
+            mask &= self.mask_unique[:, :, 0][:, :, np.newaxis]
+        return mask
+
+    def select_ba_points(
+            self, num_points, camera_id_list=None, ignore_joint_list=None, unique=False,
+            img_id_offset=0, corrected=None
+    ):
+        """
+        Picks at most num_points (image, joint) pairs for the bundle adjustment.
+        Points of each joint are binned on a 3d grid, so that the whole range of motion is covered,
+        and the most confident detections in each cell are taken first.
+        img_id_offset: image id of the first row of the 2d points, see Camera.get_heatmap_confidence
+        corrected: dict of cam_id to num_images bool array, images manually corrected by the user,
+        whose points have confidence 1
+        Returns num_images x num_joints bool array.
+        """
+        if ignore_joint_list is None:
+            ignore_joint_list = config["skeleton"].ignore_joint_id
+        if camera_id_list is None:
+            camera_id_list = list(range(self.num_cameras))
+        cam_list = [self.cam_list[c] for c in camera_id_list]
+
+        mask = self.ba_observation_mask(cam_list, ignore_joint_list, unique)
+        valid = np.sum(mask, axis=2) >= 2
+        if np.count_nonzero(valid) <= num_points:
+            return valid
+
+        # mean heatmap confidence over the cameras observing the point
+        confidence = np.stack([cam.get_heatmap_confidence(img_id_offset) for cam in cam_list], axis=2)
+        if corrected is not None:
+            for cam_idx, cam in enumerate(cam_list):
+                if cam.cam_id in corrected:
+                    confidence[corrected[cam.cam_id], :, cam_idx] = 1
+        confidence = np.sum(confidence * mask, axis=2) / np.maximum(np.sum(mask, axis=2), 1)
+
+        img_id, j_id = np.nonzero(valid)
+        pts3d = self.points3d_m[img_id, j_id]
+        joints = np.unique(j_id)
+        num_bins = max(1, int(np.round((num_points / joints.size) ** (1 / 3))))
+        pts_min = np.full((self.points3d_m.shape[1], 3), np.inf)
+        pts_max = np.full((self.points3d_m.shape[1], 3), -np.inf)
+        np.minimum.at(pts_min, j_id, pts3d)
+        np.maximum.at(pts_max, j_id, pts3d)
+        extent = np.maximum(pts_max[j_id] - pts_min[j_id], 1e-9)
+        b = np.clip(((pts3d - pts_min[j_id]) / extent * num_bins).astype(int), 0, num_bins - 1)
+        cell = ((j_id * num_bins + b[:, 0]) * num_bins + b[:, 1]) * num_bins + b[:, 2]
+
+        # rank of each point inside its cell, by decreasing confidence
+        conf = confidence[img_id, j_id]
+        order = np.lexsort((-conf, cell))
+        cell_sorted = cell[order]
+        first = np.flatnonzero(np.r_[True, cell_sorted[1:] != cell_sorted[:-1]])
+        rank = np.empty_like(order)
+        rank[order] = np.arange(order.size) - np.repeat(first, np.diff(np.r_[first, order.size]))
+
+        # best point of every cell, then the second best, ...
+        selected = np.lexsort((-conf, rank))[:num_points]
+        point_mask = np.zeros_like(valid)
+        point_mask[img_id[selected], j_id[selected]] = True
+        getLogger('df3d').debug(
+            "Selected {} of {} points for bundle adjustment".format(selected.size, img_id.size)
+        )
+        return point_mask
 
     def prepare_bundle_adjust_param(
-            self, camera_id_list=None, ignore_joint_list=None, unique=False, prior=True
+            self, camera_id_list=None, ignore_joint_list=None, unique=False, prior=True, point_mask=None
     ):
         if ignore_joint_list is None:
             ignore_joint_list = config["skeleton"].ignore_joint_id
@@ -302,84 +412,51 @@ class CameraNetwork:
 
         camera_params = np.zeros(shape=(len(camera_id_list), 13), dtype=float)
         cam_list = [self.cam_list[c] for c in camera_id_list]
-        for i, cid in enumerate(camera_id_list):
-            camera_params[i, 0:3] = np.squeeze(cam_list[cid].rvec)
-            camera_params[i, 3:6] = np.squeeze(cam_list[cid].tvec)
-            camera_params[i, 6] = cam_list[cid].focal_length_x
-            camera_params[i, 7] = cam_list[cid].focal_length_y
-            camera_params[i, 8:13] = np.squeeze(cam_list[cid].distort)
-
-        point_indices = []
-        camera_indices = []
-        points2d_ba = []
-        points3d_ba = []
-        points3d_ba_source = dict()
-        points3d_ba_source_inv = dict()
-        point_index_counter = 0
-        data_shape = self.points3d_m.shape
-        for img_id in range(data_shape[0]):
-            for j_id in range(data_shape[1]):
-                cam_list_iter = list()
-                points2d_iter = list()
-                for cam in cam_list:
-                    if j_id in ignore_joint_list:
-                        continue
-                    if np.any(self.points3d_m[img_id, j_id, :] == 0):
-                        continue
-                    if np.any(cam[img_id, j_id, :] == 0):
-                        continue
-                    if not config["skeleton"].camera_see_joint(cam.cam_id, j_id):
-                        continue
-                    # if prior and not self.mask_prior[img_id, j_id, 0]:
-                    #    continue
-                    if unique and not self.mask_unique[img_id, j_id, 0]:
-                        continue
-                    if cam.cam_id == 3:
-                        continue
-
-                    cam_list_iter.append(cam)
-                    points2d_iter.append(cam[img_id, j_id, :])
-
-                # the point is seen by at least two cameras, add it to the bundle adjustment
-                if len(cam_list_iter) >= 2:
-                    points3d_iter = self.points3d_m[img_id, j_id, :]
-                    points2d_ba.extend(points2d_iter)
-                    points3d_ba.append(points3d_iter)
-                    point_indices.extend([point_index_counter] * len(cam_list_iter))
-                    points3d_ba_source[(img_id, j_id)] = point_index_counter
-                    points3d_ba_source_inv[point_index_counter] = (img_id, j_id)
-                    point_index_counter += 1
-                    camera_indices.extend([cam.cam_id for cam in cam_list_iter])
-
-        c = 0
+        for i, cam in enumerate(cam_list):
+            camera_params[i, 0:3] = np.squeeze(cam.rvec)
+            camera_params[i, 3:6] = np.squeeze(cam.tvec)
+            camera_params[i, 6] = cam.focal_length_x
+            camera_params[i, 7] = cam.focal_length_y
+            camera_params[i, 8:13] = np.squeeze(cam.distort)
+
+        # observation mask over (image, joint, camera)
+        skeleton = config["skeleton"]
+        points2d = np.stack([cam.points2d for cam in cam_list], axis=2)
+        mask = self.ba_observation_mask(cam_list, ignore_joint_list, unique)
+        if point_mask is not None:
+            mask &= point_mask[:, :, np.newaxis]
+
+        # the point is seen by at least two cameras, add it to the bundle adjustment
+        valid = np.sum(mask, axis=2) >= 2
+        mask &= valid[:, :, np.newaxis]
+        point_id = np.full(valid.shape, -1, dtype=int)
+        point_id[valid] = np.arange(np.count_nonzero(valid))
+        points3d_ba = self.points3d_m[valid]
+
         # make sure stripes from both sides share the same point id's
         # TODO move this into config file
         if "fly" in config["name"]:
-            for idx, point_idx in enumerate(point_indices):
-                img_id, j_id = points3d_ba_source_inv[point_idx]
-                if (
-                        config["skeleton"].is_tracked_point(j_id, config["skeleton"].Tracked.STRIPE)
-                        and j_id > config["skeleton"].num_joints // 2
-                ):
-                    if (img_id, j_id - config["skeleton"].num_joints // 2) in points3d_ba_source:
-                        point_indices[idx] = points3d_ba_source[
-                            (img_id, j_id - config["skeleton"].num_joints // 2)
-                        ]
-                        c += 1
-
-        getLogger('df3d').debug("Replaced {} points".format(c))
-        points3d_ba = np.squeeze(np.array(points3d_ba))
-        points2d_ba = np.squeeze(np.array(points2d_ba))
-        cid2cidx = {v:k for (k,v) in enumerate(np.sort(np.unique(camera_indices)))}
-        camera_indices = [cid2cidx[cid] for cid in camera_indices]
-        camera_indices = np.array(camera_indices)
-        point_indices = np.array(point_indices)
-
-        '''
-        camera_indices -= np.min(
-            camera_indices
-        )  # XXX assumes cameras are consecutive :/
-        '''
+            half = skeleton.num_joints // 2
+            stripe_joints = np.flatnonzero(
+                skeleton.tracked_point_arr[skeleton.Tracked.STRIPE]
+                & (np.arange(skeleton.num_joints) > half)
+            )
+            other_side = point_id[:, stripe_joints - half]
+            merge = (other_side >= 0) & valid[:, stripe_joints]
+            point_id_merged = point_id.copy()
+            point_id_merged[:, stripe_joints] = np.where(
+                merge, other_side, point_id[:, stripe_joints]
+            )
+            getLogger('df3d').debug(
+                "Replaced {} points".format(np.sum(mask[:, stripe_joints][merge]))
+            )
+        else:
+            point_id_merged = point_id
+
+        # observations ordered by image, joint and then camera
+        img_idx, j_idx, camera_indices = np.nonzero(mask)
+        points2d_ba = points2d[img_idx, j_idx, camera_indices]
+        point_indices = point_id_merged[img_idx, j_idx]
 
         n_cameras = camera_params.shape[0]
         n_points = points3d_ba.shape[0]
@@ -401,35 +478,50 @@ class CameraNetwork:
             ignore_joint_list=config["skeleton"].ignore_joint_id,
             unique=False,
             prior=False,
+            max_points=None,
+            img_id_offset=0,
+            corrected=None,
     ):
+        """
+        Optimizes the extrinsics of the cameras in cam_id_list, then triangulates all the images again.
+        If max_points is set, only a subset of the points, see select_ba_points, is used for the optimization.
+        img_id_offset and corrected are passed to select_ba_points.
+        """
         assert(self.cam_list)
         if cam_id_list is None:
             cam_id_list = range(self.num_cameras)
 
-        self.reprojection_error(
-            cam_indices=cam_id_list, ignore_joint_list=ignore_joint_list
-        )
+        logger = getLogger('df3d')
+        if logger.isEnabledFor(logging.DEBUG):
+            self.reprojection_error(
+                cam_indices=cam_id_list, ignore_joint_list=ignore_joint_list
+            )
+        point_mask = None
+        if max_points is not None:
+            point_mask = self.select_ba_points(
+                max_points, cam_id_list, ignore_joint_list=ignore_joint_list, unique=unique,
+                img_id_offset=img_id_offset, corrected=corrected,
+            )
         x0, points_2d, n_cameras, n_points, camera_indices, point_indices = self.prepare_bundle_adjust_param(
             cam_id_list,
             ignore_joint_list=ignore_joint_list,
             unique=unique,
             prior=prior,
+            point_mask=point_mask,
         )
-        logger = getLogger('df3d')
         logger.debug(f"Number of points: {n_points}")
-        A = bundle_adjustment_sparsity(
-            n_cameras, n_points, camera_indices, point_indices
-        )
+        cam_list = [self.cam_list[i] for i in cam_id_list]
         res = least_squares(
             fun,
             x0,
-            jac_sparsity=A,
+            # the sparsity pattern only depends on the observations, built once for all the iterations
+            jac=partial(jac, sparsity=jac_sparsity_indices(n_cameras, camera_indices, point_indices)),
             verbose=2 if logger.isEnabledFor(logging.DEBUG) else 0,
             x_scale="jac",
             ftol=1e-4,
             method="trf",
             args=(
-                [self.cam_list[i] for i in cam_id_list],
+                cam_list,
                 n_cameras,
                 n_points,
                 camera_indices,
@@ -439,6 +531,12 @@ class CameraNetwork:
             max_nfev=1000,
         )
 
+        # residuals do not modify the cameras, set the optimized extrinsics
+        camera_params = res.x[: n_cameras * 13].reshape((n_cameras, 13))
+        for cam_idx in np.unique(camera_indices):
+            cam_list[cam_idx].set_rvec(camera_params[cam_idx, 0:3])
+            cam_list[cam_idx].set_tvec(camera_params[cam_idx, 3:6])
+
         getLogger('df3d').debug(
             "Bundle adjustment, Average reprojection error: {}".format(
                 np.mean(np.abs(res.fun))
@@ -449,58 +547,137 @@ class CameraNetwork:
 
         return res
 
-    def solveBP(self, img_id, bone_param, num_peak=10, prior=None):
+    def solveBP(self, img_id, bone_param, num_peak=10, prior=None, points3d_prev=None, return_points3d=False):
+        """
+        points3d_prev: num_joints x 3 solution of the previous image, returned with return_points3d.
+        If set, proposals of each chain are seeded by its projection and the full search
+        is run only for the chains whose seeded solution is not reliable.
+        """
         # find all the connected parts
         j_id_list_list = [
-            [j for j in range(config["skeleton"].num_joints) if config["skeleton"].limb_id[j] == limb_id]
+            np.flatnonzero(config["skeleton"].limb_id_arr == limb_id).tolist()
             for limb_id in range(config["skeleton"].num_limbs)
         ]
+        # number of cameras seeing each joint
+        num_visible = np.sum(
+            config["skeleton"].camera_see_joint_arr[[cam.cam_id for cam in self.cam_list]], axis=0
+        )
 
         chain_list = list()
         for j_id_l in j_id_list_list:
-            visible = np.zeros(shape=(len(j_id_l),), dtype=np.int)
-            for cam in self.cam_list:
-                visible += [
-                    config["skeleton"].camera_see_joint(cam.cam_id, j_id) for j_id in j_id_l
-                ]
+            visible = num_visible[j_id_l]
             if np.all(visible >= 2):
-                chain_list.append(
-                    LegBP(
+                chain = None
+                if points3d_prev is not None and np.all(np.isfinite(points3d_prev[j_id_l])):
+                    seed = project_cameras(self.cam_list, points3d_prev[j_id_l]) / config["image_shape"]
+                    chain = LegBP(
                         camera_network=self,
                         img_id=img_id,
                         j_id_list=j_id_l,
                         bone_param=bone_param,
                         num_peak=num_peak,
                         prior=prior,
+                        seed=dict(zip(j_id_l, seed)),
                     )
-                )
+                    chain.propagate()
+                    chain.solve()
+                    if not chain.seed_found or chain.max_err_proj() > config["bp_temporal_max_err"]:
+                        chain = None
+                if chain is None:
+                    chain = LegBP(
+                        camera_network=self,
+                        img_id=img_id,
+                        j_id_list=j_id_l,
+                        bone_param=bone_param,
+                        num_peak=num_peak,
+                        prior=prior,
+                    )
+                    chain.propagate()
+                    chain.solve()
+                chain_list.append(chain)
             else:
                 pass
                 # getLogger('df3d').debug("Joints {} is not visible from at least two cameras".format(j_id_l))
 
         getLogger('df3d').debug([
-                [len(leg[i].candid_list) for i in range(len(leg.jointbp))]
+                [leg[i].get_num_candid() for i in range(len(leg.jointbp))]
                 for leg in chain_list
             ])
 
-        for chain in chain_list:
-            chain.propagate()
-            chain.solve()
-
         # read the best 2d locations
         points2d_list = [
             np.zeros((config["skeleton"].num_joints, 2), dtype=float)
             for _ in range(len(self.cam_list))
         ]
+        points3d = np.full((config["skeleton"].num_joints, 3), np.nan)
         for leg in chain_list:
+            for idx, j_id in enumerate(leg.j_id_list):
+                points3d[j_id] = leg[idx].p3d[leg[idx].argmin]
             for cam_idx in range(self.num_cameras):
                 for idx, j_id in enumerate(leg.j_id_list):
-                    points2d_list[cam_idx][j_id] = leg[idx][leg[idx].argmin].p2d[
-                        cam_idx
-                    ]
+                    points2d_list[cam_idx][j_id] = leg[idx].p2d[leg[idx].argmin, cam_idx]
 
+        if return_points3d:
+            return points2d_list.copy(), points3d
         return points2d_list.copy()
 
+    def solve_bp_sequence(self, img_id_list, bone_param, num_peak=10, prior_dict=None):
+        """
+        solveBP on consecutive images, each image is seeded by the solution of the previous one.
+        returns len(img_id_list) x num_cameras x num_joints x 2 array of normalized 2d points
+        """
+        prior_dict = dict() if prior_dict is None else prior_dict
+        points2d = np.zeros((len(img_id_list), len(self.cam_list), config["skeleton"].num_joints, 2))
+        points3d, img_id_prev = None, None
+        for i, img_id in enumerate(img_id_list):
+            if img_id_prev is None or img_id != img_id_prev + 1:
+                points3d = None
+            points2d[i], points3d = self.solveBP(
+                img_id,
+                bone_param,
+                num_peak=num_peak,
+                prior=prior_dict.get(img_id),
+                points3d_prev=points3d,
+                return_points3d=True,
+            )
+            img_id_prev = img_id
+        return points2d
+
+    def solve_bp_batch(
+            self, img_id_list, bone_param, num_peak=10, prior_dict=None, num_workers=None, chunk_size=64,
+            temporal=False
+    ):
+        """
+        solveBP on many images, split in chunks of chunk_size images solved by a pool of num_workers processes.
+        Every process receives a copy of the network once, heatmaps are read from the same file.
+        prior_dict: optional dict from image id to the prior of solveBP
+        temporal: whether the images of a chunk are solved with solve_bp_sequence
+        returns len(img_id_list) x num_cameras x num_joints x 2 array of normalized 2d points
+        """
+        img_id_list = list(img_id_list)
+        prior_dict = dict() if prior_dict is None else prior_dict
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        chunk_list = [
+            [(img_id, prior_dict.get(img_id)) for img_id in img_id_list[i:i + chunk_size]]
+            for i in range(0, len(img_id_list), chunk_size)
+        ]
+
+        if num_workers <= 1 or len(chunk_list) <= 1:
+            _init_bp_worker(self, bone_param, num_peak, temporal)
+            result_list = [_solve_bp_chunk(chunk) for chunk in chunk_list]
+        else:
+            with ProcessPoolExecutor(
+                    max_workers=min(num_workers, len(chunk_list)),
+                    initializer=_init_bp_worker,
+                    initargs=(self, bone_param, num_peak, temporal),
+            ) as executor:
+                result_list = list(executor.map(_solve_bp_chunk, chunk_list))
+
+        if len(result_list) == 0:
+            return np.zeros((0, len(self.cam_list), config["skeleton"].num_joints, 2))
+        return np.concatenate(result_list)
+
     def save_network(self, path, meta=None):
         if path is not None and os.path.exists(path):  # to prevent overwriting
             d = pickle.load(open(path, "rb"))
@@ -600,3 +777,33 @@ class CameraNetwork:
         ax.set_xlabel("X")
         ax.set_ylabel("Y")
         ax.set_zlabel("Z")
+
+
+# network used by the processes of CameraNetwork.solve_bp_batch
+_bp_worker = dict()
+
+
+def _init_bp_worker(camera_network, bone_param, num_peak, temporal=False):
+    _bp_worker["camera_network"] = camera_network
+    _bp_worker["bone_param"] = bone_param
+    _bp_worker["num_peak"] = num_peak
+    _bp_worker["temporal"] = temporal
+
+
+def _solve_bp_chunk(chunk):
+    camera_network = _bp_worker["camera_network"]
+    if _bp_worker["temporal"]:
+        return camera_network.solve_bp_sequence(
+            [img_id for img_id, _ in chunk],
+            _bp_worker["bone_param"],
+            num_peak=_bp_worker["num_peak"],
+            prior_dict={img_id: prior for img_id, prior in chunk},
+        )
+    return np.array(
+        [
+            camera_network.solveBP(
+                img_id, _bp_worker["bone_param"], num_peak=_bp_worker["num_peak"], prior=prior
+            )
+            for img_id, prior in chunk
+        ]
+    )
@@ -14,7 +14,30 @@ default = {
     "alpha_bone": 10,
 }
 
+# settings shared by all the configs below
+common = {
+    # calibration, number of points used by bundle adjustment, None to use all of them
+    "calib_num_points": 5000,
+
+    # pose estimation
+    # heatmaps are stored as a "float32" memmap, or as "uint8" or "float16" compressed chunks
+    "heatmap_dtype": "float32",
+    # number of local maxima per heatmap also saved to the peaks_* folder, 0 to not save them
+    "heatmap_peaks": 0,
+
+    # belief propagation
+    # candidates kept per joint, the ones with the lowest reprojection and heatmap cost
+    "max_candid": 1000,
+    # temporal mode, proposals seeded by the previous image are kept if the solution
+    # reprojects within bp_temporal_max_err pixels, otherwise the full search is run
+    "bp_temporal": False,
+    "bp_temporal_radius": 5,
+    "bp_temporal_min_score": 0.1,
+    "bp_temporal_max_err": 10,
+}
+
 config_fly = {
+    **common,
     "name": "fly",
     "num_cameras": 7,
     "image_shape": [960, 480],
@@ -73,6 +96,7 @@ config_fly = {
 }
 
 config_h36m = {
+    **common,
     "name": "h36m",
     "num_cameras": 4,
     "image_shape": [500, 500],
@@ -8,14 +8,24 @@ from .Config import config
 
 
 class PoseDB:
-    def __init__(self, folder, meta=None):
+    """
+    Manual corrections, stored as a pickled snapshot pose_corr_*.pkl and an append-only log
+    of the writes made since, pose_corr_*.pkl.log. A write only appends to the log, the
+    snapshot is rewritten by dump(), after compact_interval writes saved with dump set.
+    """
+
+    def __init__(self, folder, meta=None, compact_interval=1000):
         self.folder = folder
+        self.compact_interval = compact_interval
 
         self.db_path_list = glob.glob(os.path.join(self.folder, "pose_corr*.pkl"))
         self.last_write_image_id = 0
+        self.log_file = None
+        self.log_buffer = list()
+        self.num_log = 0
         if len(self.db_path_list) != 0:
             self.db_path = self.db_path_list[0]
-            self.db = pickle.load(open(self.db_path, "rb"))
+            self.db, self.num_log = PoseDB.load(self.db_path, return_num_log=True)
             if "train" not in self.db:
                 self.db["train"] = {i: dict() for i in range(config["num_cameras"])}
             if "modified" not in self.db:
@@ -32,6 +42,41 @@ class PoseDB:
 
             self.dump()
 
+    @staticmethod
+    def log_path(db_path):
+        return db_path + ".log"
+
+    @staticmethod
+    def load(db_path, return_num_log=False):
+        """Reads the snapshot db_path and replays the writes of its log, same dict as the pickled database"""
+        with open(db_path, "rb") as f:
+            db = pickle.load(f)
+        num_log = 0
+        if os.path.isfile(PoseDB.log_path(db_path)):
+            with open(PoseDB.log_path(db_path), "rb") as f:
+                while True:
+                    try:
+                        pts, cam_id, img_id, train, modified_joints = pickle.load(f)
+                    except (EOFError, pickle.UnpicklingError):
+                        break  # end of the log, or a write interrupted by a crash
+                    PoseDB._apply(db, pts, cam_id, img_id, train, modified_joints)
+                    num_log += 1
+        if return_num_log:
+            return db, num_log
+        return db
+
+    @staticmethod
+    def _apply(db, pts, cam_id, img_id, train, modified_joints):
+        db[cam_id][img_id] = pts
+
+        if "train" not in db:
+            db["train"] = {i: dict() for i in range(7)}
+        if "modified" not in db:
+            db["modified"] = {i: dict() for i in range(7)}
+
+        db["train"][cam_id][img_id] = train
+        db["modified"][cam_id][img_id] = modified_joints
+
     def read(self, cam_id, img_id):
         if img_id in self.db[cam_id]:
             return np.array(self.db[cam_id][img_id])
@@ -44,28 +89,57 @@ class PoseDB:
         else:
             return []
 
-    def write(self, pts, cam_id, img_id, train=False, modified_joints=None):
+    def write(self, pts, cam_id, img_id, train=False, modified_joints=None, dump=True):
+        """
+        dump: whether the write is saved to disk now, otherwise it is saved by the next
+        write with dump set, or by flush() or dump(). Only writes with dump set compact the log.
+        """
         assert pts.shape[0] == config["skeleton"].num_joints and pts.shape[1] == 2
         assert modified_joints is not None
 
         print("Writing {} {}".format(cam_id, img_id))
-        self.db[cam_id][img_id] = pts
-
-        if "train" not in self.db:
-            self.db["train"] = {i: dict() for i in range(7)}
-        if "modified" not in self.db:
-            self.db["modified"] = {i: dict() for i in range(7)}
-
-        self.db["train"][cam_id][img_id] = train
-        self.db["modified"][cam_id][img_id] = modified_joints
+        PoseDB._apply(self.db, pts, cam_id, img_id, train, modified_joints)
+        self.log_buffer.append((pts, cam_id, img_id, train, modified_joints))
 
-        # too slow?
-        self.dump()
+        if dump:
+            if self.num_log + len(self.log_buffer) >= self.compact_interval:
+                self.dump()
+            else:
+                self.flush()
         self.last_write_image_id = img_id
 
+    def flush(self):
+        """Appends the buffered writes to the log"""
+        if not self.log_buffer:
+            return
+        if self.log_file is None:
+            self.log_file = open(PoseDB.log_path(self.db_path), "ab")
+        for record in self.log_buffer:
+            pickle.dump(record, self.log_file)
+        self.log_file.flush()
+        os.fsync(self.log_file.fileno())
+        self.num_log += len(self.log_buffer)
+        self.log_buffer = list()
+
     def dump(self):
-        with open(self.db_path, "wb") as outfile:
+        """Writes the whole database to the snapshot and empties the log"""
+        # the last log entry of every key then matches the snapshot, so a crash
+        # before the log is removed replays the same values
+        self.flush()
+        tmp_path = self.db_path + ".tmp"
+        with open(tmp_path, "wb") as outfile:
             pickle.dump(self.db, outfile)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_path, self.db_path)
+
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+        if os.path.isfile(PoseDB.log_path(self.db_path)):
+            os.remove(PoseDB.log_path(self.db_path))
+        self.log_buffer = list()
+        self.num_log = 0
 
     def has_key(self, cam_id, img_id):
         return img_id in self.db[cam_id]
@@ -480,7 +480,7 @@ class DrosophAnnot(QWidget):
         visible_cameras = [
             cam
             for cam in camNet
-            if config["skeleton"].camera_see_joint(cam.cam_id, joint_id)
+            if config["skeleton"].camera_see_joint_arr[cam.cam_id, joint_id]
         ]
         if len(visible_cameras) >= 2:
             pts = np.array(
@@ -710,13 +710,12 @@ class DrosophAnnot(QWidget):
 
         if "fly" in config["name"]:
             # some post-processing for body-coxa
+            is_body_coxa = config["skeleton"].tracked_point_arr[config["skeleton"].Tracked.BODY_COXA]
             for cam_id in range(len(self.camNetAll.cam_list)):
-                for j in range(config["skeleton"].num_joints):
-                    if config["skeleton"].camera_see_joint(cam_id, j) and config[
-                        "skeleton"
-                    ].is_tracked_point(j, config["skeleton"].Tracked.BODY_COXA):
-                        pts2d[cam_id, :, j, 0] = np.median(pts2d[cam_id, :, j, 0])
-                        pts2d[cam_id, :, j, 1] = np.median(pts2d[cam_id, :, j, 1])
+                j = np.flatnonzero(
+                    np.logical_and(config["skeleton"].camera_see_joint_arr[cam_id], is_body_coxa)
+                )
+                pts2d[cam_id][:, j, :] = np.median(pts2d[cam_id][:, j, :], axis=0)
 
         dict_merge = self.camNetAll.save_network(path=None)
         dict_merge["points2d"] = pts2d
@@ -735,6 +734,7 @@ class DrosophAnnot(QWidget):
                 if self.state.db.has_key(cam_id, img_id):
                     pt = self.state.db.read(cam_id, img_id) * config["image_shape"]
                     self.camNetAll[cam_id].points2d[img_id, :] = pt
+                    self.camNetAll[cam_id].invalidate()
                     c += 1
         print("Replaced points2d with {} manual correction".format(count))
 
@@ -814,7 +814,7 @@ class ImagePose(QWidget):
         visible_cameras = [
             cam
             for cam in camNet
-            if config["skeleton"].camera_see_joint(cam.cam_id, joint_id)
+            if config["skeleton"].camera_see_joint_arr[cam.cam_id, joint_id]
         ]
         if len(visible_cameras) >= 2:
             pts = np.array(
@@ -829,11 +829,9 @@ class ImagePose(QWidget):
         return err_proj
 
     def update_image_pose(self):
-        draw_joints = [
-            j
-            for j in range(config["skeleton"].num_joints)
-            if config["skeleton"].camera_see_joint(self.cam.cam_id, j)
-        ]
+        draw_joints = np.flatnonzero(
+            config["skeleton"].camera_see_joint_arr[self.cam.cam_id]
+        ).tolist()
         corrected_this_camera = self.state.db.has_key(
             self.cam.cam_id, self.state.img_id
         )
@@ -844,11 +842,9 @@ class ImagePose(QWidget):
             draw_joints = (
                 [self.state.hm_joint_id]
                 if self.state.hm_joint_id != -1
-                else [
-                    j
-                    for j in range(config["skeleton"].num_joints)
-                    if config["skeleton"].camera_see_joint(self.cam.cam_id, j)
-                ]
+                else np.flatnonzero(
+                    config["skeleton"].camera_see_joint_arr[self.cam.cam_id]
+                ).tolist()
             )
             im = self.cam.plot_heatmap(
                 img_id=self.state.img_id, concat=False, scale=2, draw_joints=draw_joints
@@ -899,12 +895,12 @@ class ImagePose(QWidget):
         points2d_correction = self.dynamic_pose.points2d
 
         err = np.abs(points2d_correction - points2d_prediction)
-        check_joint_id_list = [
-            j
-            for j in range(config["num_joints"])
-            if (j not in config["skeleton"].ignore_joint_id)
-            and config["skeleton"].camera_see_joint(self.cam.cam_id, j)
-        ]
+        check_joint_id_list = np.flatnonzero(
+            np.logical_and(
+                np.logical_not(config["skeleton"].ignore_joint_arr),
+                config["skeleton"].camera_see_joint_arr[self.cam.cam_id],
+            )
+        ).tolist()
 
         for j in check_joint_id_list:
             if np.any(err[j] > thr):
@@ -917,11 +913,9 @@ class ImagePose(QWidget):
                     )
                 )
                 # make sure we are not saving a points that cannot be seen from the camera
-                unseen_joints = [
-                    j
-                    for j in range(config["skeleton"].num_joints)
-                    if not config["skeleton"].camera_see_joint(self.cam.cam_id, j)
-                ]
+                unseen_joints = np.logical_not(
+                    config["skeleton"].camera_see_joint_arr[self.cam.cam_id]
+                )
                 points2d_correction[unseen_joints, :] = 0.0
                 self.state.db.write(
                     points2d_correction / config["image_shape"],
@@ -956,13 +950,7 @@ class ImagePose(QWidget):
 
                 # make sure we don't select points we cannot see
                 pts[
-                    [
-                        j_id
-                        for j_id in range(config["skeleton"].num_joints)
-                        if not config["skeleton"].camera_see_joint(
-                            self.cam.cam_id, j_id
-                        )
-                    ]
+                    np.logical_not(config["skeleton"].camera_see_joint_arr[self.cam.cam_id])
                 ] = [9999, 9999]
 
                 nbrs = NearestNeighbors(n_neighbors=1, algorithm="ball_tree").fit(pts)
@@ -971,6 +959,8 @@ class ImagePose(QWidget):
                 self.dynamic_pose.joint_id = indices[0][0]
                 print("Selecting the joint: {}".format(self.dynamic_pose.joint_id))
             self.dynamic_pose.set_joint(self.dynamic_pose.joint_id, np.array([x, y]))
+            # the dynamic pose can be a view of the 2d points of the camera
+            self.cam.invalidate()
             self.update_image_pose()
 
     def mouseReleaseEvent(self, e):
@@ -76,8 +76,7 @@ class DrosophAnnot():
         # setting the initial state
         #self.set_pose(self.state.img_id)
         #change do beleif propegation on all images not just the first one
-        for i in range(0, self.state.num_images):
-            self.set_pose(i)
+        self.solve_bp_all()
         self.set_mode(self.state.mode)
 
     def set_cameras(self):
@@ -231,6 +230,72 @@ class DrosophAnnot():
 
         print("Finished Belief Propagation")
 
+    def solve_bp_all(self, num_workers=None):
+        """
+        Same as calling set_pose on every image, belief propagation of all the images is solved
+        by CameraNetwork.solve_bp_batch and the corrections are written to the database once at the end.
+        """
+        if not (
+            self.state.mode == Mode.CORRECTION
+            and self.state.solve_bp
+            and self.camNetLeft.has_calibration()
+            and self.camNetLeft.has_pose()
+        ):
+            print("solve BP exiting w/o run")
+            return
+
+        img_id_list = list(range(self.state.num_images))
+        for cam_net_this_side, image_pose_list_this_side in [
+            (self.camNetLeft, self.image_pose_list),
+            (self.camNetRight, self.image_pose_list_bot),
+        ]:
+            if not cam_net_this_side.has_calibration():
+                continue
+
+            # manual corrections in the database are the priors
+            pose_dict = dict()
+            prior_dict = dict()
+            for img_id in img_id_list:
+                prior_dict[img_id] = list()
+                for ip in image_pose_list_this_side:
+                    pt = self.state.db.read(ip.cam.cam_id, img_id)
+                    if pt is None:
+                        pt = ip.cam.points2d[img_id, :]
+                    else:
+                        pt *= config["image_shape"]
+                    modified_joints = self.state.db.read_modified_joints(ip.cam.cam_id, img_id)
+                    pose_dict[(ip.cam.cam_id, img_id)] = (pt, modified_joints)
+                    for joint_id in modified_joints:
+                        prior_dict[img_id].append(
+                            (ip.cam.cam_id, joint_id, pt[joint_id] / config["image_shape"])
+                        )
+
+            pts_bp = cam_net_this_side.solve_bp_batch(
+                img_id_list,
+                config["bone_param"],
+                prior_dict=prior_dict,
+                num_workers=num_workers,
+                temporal=config["bp_temporal"],
+            )
+
+            # set points which are not estimated by bp, and save the corrections
+            for img_id, pts_bp_img in zip(img_id_list, pts_bp):
+                self.state.img_id = img_id
+                for idx, ip in enumerate(image_pose_list_this_side):
+                    pt, modified_joints = pose_dict[(ip.cam.cam_id, img_id)]
+                    pts_bp_ip = pts_bp_img[idx] * config["image_shape"]
+                    pts_bp_ip[pts_bp_ip == 0] = pt[pts_bp_ip == 0]
+                    ip.dynamic_pose = DynamicPose(
+                        pts_bp_ip,
+                        img_id,
+                        joint_id=None,
+                        manual_correction={joint_id: pt[joint_id] for joint_id in modified_joints},
+                    )
+                    ip.save_correction(dump=False)
+
+        self.state.db.dump()
+        print("Finished Belief Propagation")
+
     def set_pose(self, img_id):
         print("image_id: "+str(img_id))
         self.state.img_id = img_id
@@ -324,13 +389,12 @@ class DrosophAnnot():
 
         if "fly" in config["name"]:
             # some post-processing for body-coxa
+            is_body_coxa = config["skeleton"].tracked_point_arr[config["skeleton"].Tracked.BODY_COXA]
             for cam_id in range(len(self.camNetAll.cam_list)):
-                for j in range(config["skeleton"].num_joints):
-                    if config["skeleton"].camera_see_joint(cam_id, j) and config[
-                        "skeleton"
-                    ].is_tracked_point(j, config["skeleton"].Tracked.BODY_COXA):
-                        pts2d[cam_id, :, j, 0] = np.median(pts2d[cam_id, :, j, 0])
-                        pts2d[cam_id, :, j, 1] = np.median(pts2d[cam_id, :, j, 1])
+                j = np.flatnonzero(
+                    np.logical_and(config["skeleton"].camera_see_joint_arr[cam_id], is_body_coxa)
+                )
+                pts2d[cam_id][:, j, :] = np.median(pts2d[cam_id][:, j, :], axis=0)
 
         dict_merge = self.camNetAll.save_network(path=None)
         dict_merge["points2d"] = pts2d
@@ -349,6 +413,7 @@ class DrosophAnnot():
                 if self.state.db.has_key(cam_id, img_id):
                     pt = self.state.db.read(cam_id, img_id) * config["image_shape"]
                     self.camNetAll[cam_id].points2d[img_id, :] = pt
+                    self.camNetAll[cam_id].invalidate()
                     c += 1
         print("Replaced points2d with {} manual correction".format(count))
 
@@ -413,17 +478,17 @@ class ImagePose():
         self.dynamic_pose = None
 
 
-    def save_correction(self, thr=30):
+    def save_correction(self, thr=30, dump=True):
         points2d_prediction = self.cam.get_points2d(self.state.img_id) #may need to have .copy() here depending
         points2d_correction = self.dynamic_pose.points2d
 
         err = np.abs(points2d_correction - points2d_prediction)
-        check_joint_id_list = [#list of joints that arent ignored and that this camera can see
-            j
-            for j in range(config["num_joints"])
-            if (j not in config["skeleton"].ignore_joint_id)
-            and config["skeleton"].camera_see_joint(self.cam.cam_id, j)
-        ]
+        check_joint_id_list = np.flatnonzero(#list of joints that arent ignored and that this camera can see
+            np.logical_and(
+                np.logical_not(config["skeleton"].ignore_joint_arr),
+                config["skeleton"].camera_see_joint_arr[self.cam.cam_id],
+            )
+        ).tolist()
 
         for j in check_joint_id_list:
             if np.any(err[j] > thr):
@@ -438,11 +503,9 @@ class ImagePose():
                     )
                 )
                 # make sure we are not saving a points that cannot be seen from the camera
-                unseen_joints = [
-                    j
-                    for j in range(config["skeleton"].num_joints)
-                    if not config["skeleton"].camera_see_joint(self.cam.cam_id, j)
-                ]
+                unseen_joints = np.logical_not(
+                    config["skeleton"].camera_see_joint_arr[self.cam.cam_id]
+                )
                 #points2d_prediction[unseen_joints, :] = 0.0
                 points2d_correction[unseen_joints, :] = 0.0
                 self.state.db.write(
@@ -454,6 +517,7 @@ class ImagePose():
                     modified_joints=list(
                         self.dynamic_pose.manual_correction_dict.keys()
                     ),
+                    dump=dump,
                 )
 
                 return True
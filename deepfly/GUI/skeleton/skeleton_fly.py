@@ -241,6 +241,30 @@ def camera_see_joint(camera_id, joint_id):
         raise NotImplementedError
 
 
+# camera_see_joint, limb_id and tracked_points as arrays indexed by camera and joint,
+# camera 7 is the mirrored camera 3, hence num_cameras + 1 rows
+num_cameras = 7
+camera_see_joint_arr = np.array(
+    [[camera_see_joint(cam_id, j) for j in range(num_joints)] for cam_id in range(num_cameras + 1)],
+    dtype=bool,
+)
+limb_id_arr = np.array(limb_id, dtype=int)
+tracked_point_arr = {
+    tracked_point: np.array([t == tracked_point for t in tracked_points], dtype=bool)
+    for tracked_point in Tracked
+}
+# joints with a joint angle, between the previous and the next joint of the list
+angle_joint_arr = ~(
+    tracked_point_arr[Tracked.TARSUS_TIP]
+    | tracked_point_arr[Tracked.STRIPE]
+    | tracked_point_arr[Tracked.ANTENNA]
+)
+angle_joint_arr[[0, -1]] = False
+angle_joint_id = np.flatnonzero(angle_joint_arr)
+angle_parent_id = angle_joint_id - 1
+angle_child_id = angle_joint_id + 1
+
+
 bone_param = np.ones((num_joints, 2), dtype=float)
 bone_param[:, 0] = 0.9
 bone_param[:, 1] = 0.3
@@ -257,6 +281,8 @@ ignore_joint_id = [
     is_tracked_point(joint_id, Tracked.BODY_COXA) or is_tracked_point(joint_id, Tracked.COXA_FEMUR) or is_tracked_point(
         joint_id, Tracked.ANTENNA)
 ]
+ignore_joint_arr = np.zeros(num_joints, dtype=bool)
+ignore_joint_arr[ignore_joint_id] = True
 
 # joints to be ignored during calibration
 ignore_joint_id_wo_stripe = [
@@ -105,6 +105,7 @@ bone_param[:, 1] = 99999
 pictorial_joint_list = [j for j in range(num_joints)]
 
 ignore_joint_id = []
+ignore_joint_arr = np.zeros(num_joints, dtype=bool)
 zorder = np.arange(num_limbs)
 zorder = [zorder[get_limb_id(j)] for j in range(num_joints)]
 
@@ -115,3 +116,23 @@ def get_zorder(cam_id):
 
 def camera_see_joint(camera_id, joint_id):
     return True
+
+
+# same arrays as skeleton_fly, with its extra camera row
+num_cameras = 4
+camera_see_joint_arr = np.array(
+    [[camera_see_joint(cam_id, j) for j in range(num_joints)] for cam_id in range(num_cameras + 1)],
+    dtype=bool,
+)
+limb_id_arr = np.array(limb_id, dtype=int)
+tracked_point_arr = {
+    tracked_point: np.array([t == tracked_point for t in tracked_points], dtype=bool)
+    for tracked_point in Tracked
+}
+
+# joints with a joint angle, between the previous and the next joint of the list
+angle_joint_arr = np.ones(num_joints, dtype=bool)
+angle_joint_arr[[0, -1]] = False
+angle_joint_id = np.flatnonzero(angle_joint_arr)
+angle_parent_id = angle_joint_id - 1
+angle_child_id = angle_joint_id + 1
@@ -1,5 +1,117 @@
 import numpy as np
-from scipy.sparse import lil_matrix
+from scipy.sparse import csr_matrix
+
+
+def skew(v):
+    """
+    v: nx3 array
+    returns nx3x3 array of cross product matrices
+    """
+    zero = np.zeros(v.shape[0])
+    return np.stack(
+        [
+            np.stack([zero, -v[:, 2], v[:, 1]], axis=1),
+            np.stack([v[:, 2], zero, -v[:, 0]], axis=1),
+            np.stack([-v[:, 1], v[:, 0], zero], axis=1),
+        ],
+        axis=1,
+    )
+
+
+def rodrigues(rvec):
+    """
+    Batched cv2.Rodrigues, from rotation vectors to rotation matrices.
+    rvec: nx3 array
+    returns nx3x3 array
+    """
+    theta = np.linalg.norm(rvec, axis=1)
+    small = theta < 1e-12
+    k = rvec / np.where(small, 1.0, theta)[:, np.newaxis]
+    K = skew(k)
+    sin = np.sin(theta)[:, np.newaxis, np.newaxis]
+    cos = np.cos(theta)[:, np.newaxis, np.newaxis]
+    R = np.eye(3) + sin * K + (1 - cos) * np.matmul(K, K)
+    # first order approximation around the identity
+    R[small] = np.eye(3) + skew(rvec[small])
+    return R
+
+
+def rotation_jacobian(rvec, R, points3d):
+    """
+    Derivative of R(rvec) * points3d with respect to rvec,
+    see Gallego and Yezzi, "A compact formula for the derivative of a 3-D rotation in exponential coordinates".
+    rvec: nx3, R: nx3x3, points3d: nx3
+    returns nx3x3 array
+    """
+    theta2 = np.sum(rvec * rvec, axis=1)
+    small = theta2 < 1e-24
+    A = np.einsum("ni,nj->nij", rvec, rvec) + np.matmul(
+        np.swapaxes(R, 1, 2) - np.eye(3), skew(rvec)
+    )
+    A /= np.where(small, 1.0, theta2)[:, np.newaxis, np.newaxis]
+    J = -np.matmul(np.matmul(R, skew(points3d)), A)
+    J[small] = -skew(points3d[small])
+    return J
+
+
+def project_batch(points3d, rvec, tvec, intr, distort, camera_indices, jacobian=False):
+    """
+    Projects points3d[i] with camera camera_indices[i], same as cv2.projectPoints
+    with the (k1, k2, p1, p2, k3) distortion model.
+    points3d: mx3 array
+    rvec, tvec: nx3 arrays, intr: nx3x3 array, distort: nx5 array, one row per camera
+    camera_indices: m array
+    returns mx2 projections in pixels, and if jacobian is set, the mx2x3 derivatives
+    with respect to rvec, tvec and points3d
+    """
+    R = rodrigues(rvec)[camera_indices]
+    points_cam = np.einsum("mij,mj->mi", R, points3d) + tvec[camera_indices]
+    z = points_cam[:, 2]
+    x = points_cam[:, 0] / z
+    y = points_cam[:, 1] / z
+
+    k1, k2, p1, p2, k3 = distort[camera_indices].T
+    r2 = x * x + y * y
+    radial = 1 + k1 * r2 + k2 * r2 * r2 + k3 * r2 * r2 * r2
+    x_d = x * radial + 2 * p1 * x * y + p2 * (r2 + 2 * x * x)
+    y_d = y * radial + p1 * (r2 + 2 * y * y) + 2 * p2 * x * y
+
+    fx, fy = intr[camera_indices, 0, 0], intr[camera_indices, 1, 1]
+    cx, cy = intr[camera_indices, 0, 2], intr[camera_indices, 1, 2]
+    points2d = np.stack([fx * x_d + cx, fy * y_d + cy], axis=1)
+    if not jacobian:
+        return points2d
+
+    # pixel coordinates w.r.t. normalized coordinates
+    d_radial = k1 + 2 * k2 * r2 + 3 * k3 * r2 * r2
+    dxd_dy = 2 * x * y * d_radial + 2 * p1 * x + 2 * p2 * y
+    J_xy = np.empty((x.shape[0], 2, 2))
+    J_xy[:, 0, 0] = fx * (radial + 2 * x * x * d_radial + 2 * p1 * y + 6 * p2 * x)
+    J_xy[:, 0, 1] = fx * dxd_dy
+    J_xy[:, 1, 0] = fy * dxd_dy
+    J_xy[:, 1, 1] = fy * (radial + 2 * y * y * d_radial + 6 * p1 * y + 2 * p2 * x)
+
+    # normalized coordinates w.r.t. camera coordinates
+    J_cam = np.zeros((x.shape[0], 2, 3))
+    J_cam[:, 0, 0] = 1 / z
+    J_cam[:, 0, 2] = -x / z
+    J_cam[:, 1, 1] = 1 / z
+    J_cam[:, 1, 2] = -y / z
+
+    J_tvec = np.matmul(J_xy, J_cam)
+    J_points3d = np.matmul(J_tvec, R)
+    J_rvec = np.matmul(
+        J_tvec, rotation_jacobian(rvec[camera_indices], R, points3d)
+    )
+    return points2d, (J_rvec, J_tvec, J_points3d)
+
+
+def _camera_intrinsics(cam_list, n_cameras):
+    intr = np.array([cam.intr for cam in cam_list[:n_cameras]], dtype=float)
+    distort = np.array(
+        [np.squeeze(cam.distort) for cam in cam_list[:n_cameras]], dtype=float
+    )
+    return intr, distort
 
 
 def fun(
@@ -14,27 +126,23 @@ def fun(
 ):
     """Compute residuals.
     `params` contains camera parameters and 3-D coordinates.
+    Intrinsics and distortion are read from cam_list, only rotation and translation are optimized.
     """
     assert point_indices.shape[0] == points_2d.shape[0]
     assert camera_indices.shape[0] == points_2d.shape[0]
 
     camera_params = params[: n_cameras * 13].reshape((n_cameras, 13))
     points3d = params[n_cameras * 13:].reshape((n_points, 3))
-    cam_indices_list = list(set(camera_indices))
-
-    points_proj = np.zeros(shape=(point_indices.shape[0], 2), dtype=np.float)
-    for cam_id in cam_indices_list:
-        cam_list[cam_id].set_rvec(camera_params[cam_id][0:3])
-        cam_list[cam_id].set_tvec(camera_params[cam_id][3:6])
-        # cam_list[cam_id].set_focal_length(camera_params[cam_id][6], camera_params[cam_id][7])
-        # cam_list[cam_id].set_focal_length(camera_params[cam_id][6], camera_params[cam_id][7])
-        # cam_list[cam_id].set_distort(camera_params[cam_id][8:13])
-
-        points2d_mask = camera_indices == cam_id
-        points3d_where = point_indices[points2d_mask]
-        points_proj[points2d_mask, :] = cam_list[cam_id].project(
-            points3d[points3d_where]
-        )
+    intr, distort = _camera_intrinsics(cam_list, n_cameras)
+
+    points_proj = project_batch(
+        points3d[point_indices],
+        camera_params[:, 0:3],
+        camera_params[:, 3:6],
+        intr,
+        distort,
+        camera_indices,
+    )
 
     res = points_proj - points_2d
     res = res.ravel()
@@ -44,28 +152,81 @@ def fun(
     return res
 
 
-def bundle_adjustment_sparsity(n_cameras, n_points, camera_indices, point_indices):
+def jac(
+        params,
+        cam_list,
+        n_cameras,
+        n_points,
+        camera_indices,
+        point_indices,
+        points_2d,
+        residual_mask=None,
+        sparsity=None,
+):
+    """Compute the sparse jacobian of `fun`.
+    Each residual depends only on the rotation and translation of its camera, and on its 3-D point.
+    sparsity: CSR indices of the jacobian, see jac_sparsity_indices, computed here if None.
+    """
+    camera_params = params[: n_cameras * 13].reshape((n_cameras, 13))
+    points3d = params[n_cameras * 13:].reshape((n_points, 3))
+    intr, distort = _camera_intrinsics(cam_list, n_cameras)
+
+    _, (J_rvec, J_tvec, J_points3d) = project_batch(
+        points3d[point_indices],
+        camera_params[:, 0:3],
+        camera_params[:, 3:6],
+        intr,
+        distort,
+        camera_indices,
+        jacobian=True,
+    )
+    data = np.concatenate([J_rvec, J_tvec, J_points3d], axis=2)  # m x 2 x 9
+    if residual_mask is not None:
+        data *= residual_mask.reshape(-1, 2, 1)
+
+    if sparsity is None:
+        sparsity = jac_sparsity_indices(n_cameras, camera_indices, point_indices)
+    indices, indptr = sparsity
+    return csr_matrix(
+        (data.ravel(), indices, indptr),
+        shape=(camera_indices.size * 2, n_cameras * 13 + n_points * 3),
+    )
+
+
+def jac_sparsity_indices(n_cameras, camera_indices, point_indices):
+    """CSR column indices and row pointers of the jacobian computed by `jac`, computed once per optimization"""
+    return _sparsity_indices(n_cameras, camera_indices, point_indices, 6)
+
+
+def _sparsity_indices(n_cameras, camera_indices, point_indices, n_camera_cols=13):
+    """
+    CSR column indices and row pointers of the residuals w.r.t. the parameters.
+    Both coordinates of observation i depend on the first n_camera_cols parameters of
+    camera camera_indices[i] and on the 3 coordinates of point point_indices[i].
+    """
     assert camera_indices.shape[0] == point_indices.shape[0]
     n_camera_params = 13
-    # m = camera_indices.size * 2 # x,y for each 3d point
-    m = (
-            camera_indices.size * 2
-    )  # + n_cameras * 3 + n_cameras * 3 + 3  # residuals, reprojection error for each dimension and translation error and rotation error and align error
-    # notice that camera_incides.size gives the number of observations
+    # camera columns come before the point columns, so every row is already sorted
+    cols = np.concatenate(
+        [
+            camera_indices[:, np.newaxis] * n_camera_params + np.arange(n_camera_cols),
+            n_cameras * n_camera_params + point_indices[:, np.newaxis] * 3 + np.arange(3),
+        ],
+        axis=1,
+    )
+    indices = np.repeat(cols, 2, axis=0).ravel()  # same columns for x and y residuals
+    n_cols = n_camera_cols + 3
+    indptr = np.arange(0, (camera_indices.size * 2 + 1) * n_cols, n_cols)
+    return indices, indptr
+
 
+def bundle_adjustment_sparsity(n_cameras, n_points, camera_indices, point_indices):
+    assert camera_indices.shape[0] == point_indices.shape[0]
+    n_camera_params = 13
+    m = camera_indices.size * 2  # x,y residuals for each observation
     n = (
             n_cameras * n_camera_params + n_points * 3
     )  # all the parameters, 13 camera parameters and x,y,z values for n_points
-    A = lil_matrix((m, n), dtype=int)  # sparse matrix
-
-    i = np.arange(camera_indices.size)
-    for s in range(
-            n_camera_params
-    ):  # assign camera parameters to points residuals (reprojection error)
-        A[2 * i, camera_indices * n_camera_params + s] = 1
-        A[2 * i + 1, camera_indices * n_camera_params + s] = 1
-
-    for s in range(3):  # assign 3d points to residuals (reprojection error)
-        A[2 * i, n_cameras * n_camera_params + point_indices * 3 + s] = 1
-        A[2 * i + 1, n_cameras * n_camera_params + point_indices * 3 + s] = 1
-    return A
+
+    indices, indptr = _sparsity_indices(n_cameras, camera_indices, point_indices, n_camera_params)
+    return csr_matrix((np.ones(indices.size, dtype=int), indices, indptr), shape=(m, n))
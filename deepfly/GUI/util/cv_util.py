@@ -158,6 +158,43 @@ def triangulate_linear(cam_list, point_list):
     return points3d
 
 
+def nview_linear_triangulation_batch(proj, points2d, mask):
+    """
+    Computes world coordinates of all the points at once, same as calling
+    nview_linear_triangulation_single for every (image, joint) pair.
+    :param proj: stacked projection matrices of the cameras
+    :type proj: numpy.ndarray, shape=(C, 3, 4)
+    :param points2d: image coordinates, in pixels
+    :type points2d: numpy.ndarray, shape=(N, J, C, 2)
+    :param mask: whether the observation of camera c is used for the point
+    :type mask: numpy.ndarray, shape=(N, J, C), bool
+    :return: world coordinates, zero for points seen by less than two cameras
+    :rtype: numpy.ndarray, shape=(N, J, 3)
+    """
+    proj = np.asarray(proj, dtype=float)
+    points2d = np.asarray(points2d, dtype=float)
+    assert proj.shape[1:] == (3, 4)
+    assert points2d.shape[2:] == (proj.shape[0], 2)
+    assert mask.shape == points2d.shape[:3]
+
+    # two rows of matrix D per camera, rows of unused observations are zeroed
+    D = points2d[..., np.newaxis] * proj[:, np.newaxis, 2, :] - proj[:, :2, :]
+    D *= mask[..., np.newaxis, np.newaxis]
+    D = D.reshape(points2d.shape[:2] + (-1, 4))
+    Q = np.matmul(np.swapaxes(D, -1, -2), D)
+
+    # Q is symmetric, eigenvector of the smallest eigenvalue is the last
+    # left singular vector of Q
+    _, v = np.linalg.eigh(Q)
+    points3d_hom = v[..., :, 0]
+
+    valid = np.sum(mask, axis=-1) >= 2
+    w = np.where(valid, points3d_hom[..., 3], 1.0)
+    points3d = points3d_hom[..., :3] / w[..., np.newaxis]
+    points3d[~valid] = 0
+    return points3d
+
+
 """
 n-view linear triangulation
 https://github.com/smidm/camera.py/blob/master/camera.py
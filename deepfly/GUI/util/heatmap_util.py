@@ -0,0 +1,401 @@
+import json
+import os
+import struct
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+_magic = b"DF3DHM2\n"
+_length = struct.Struct("<Q")
+_record = struct.Struct("<4sIIQdd")  # tag, camera, block, length, low, high
+_record_tag = b"HMCK"
+_footer = struct.Struct("<Q8s")  # offset of the index, tag
+_footer_tag = b"DF3DIDX\n"
+
+
+class HeatmapStore:
+    """
+    Compressed replacement of the (cameras, images, joints, height, width) float32 heatmap memmap.
+    Heatmaps are split in chunks of block_size images of one camera, each chunk is quantized to
+    dtype ("uint8" with a per-chunk range, or "float16") and compressed with zlib.
+    Indexing reads single images, decompressing only the chunks holding them.
+
+    File layout: magic, json header, chunk records, json index, offset of the index.
+    Every chunk record starts with its camera, block, length and range, so a file left
+    without an index, e.g. when inference stopped early, is read back by scanning the records.
+    """
+
+    def __init__(self, path, cache_size=32):
+        self.path = path
+        self.cache_size = cache_size
+        self._file = None
+        self._cache = OrderedDict()
+        self._pending = dict()  # chunks being written, (cam, block) -> [array, number of images written]
+        self._writable = False
+        with open(path, "rb") as f:
+            if f.read(len(_magic)) != _magic:
+                raise ValueError("{} is not a heatmap store".format(path))
+            (header_size,) = _length.unpack(f.read(_length.size))
+            header = json.loads(f.read(header_size).decode())
+            self.shape = tuple(header["shape"])
+            self.dtype = header["dtype"]
+            self.block_size = header["block_size"]
+            self._data_start = f.tell()
+            self._chunks, self._data_end = self._read_index(f, os.path.getsize(path))
+
+    @classmethod
+    def create(cls, path, shape, dtype="uint8", block_size=16):
+        """Empty store of the given shape, missing images read as zeros"""
+        if dtype not in ("uint8", "float16"):
+            raise ValueError("Unknown heatmap dtype {}".format(dtype))
+        header = json.dumps(dict(shape=list(shape), dtype=dtype, block_size=block_size)).encode()
+        with open(path, "wb") as f:
+            f.write(_magic)
+            f.write(_length.pack(len(header)))
+            f.write(header)
+        store = cls(path)
+        store._writable = True
+        return store
+
+    @staticmethod
+    def is_store(path):
+        with open(path, "rb") as f:
+            return f.read(len(_magic)) == _magic
+
+    def _read_index(self, f, file_size):
+        """Chunk offsets from the index at the end of the file, or from the records if there is none"""
+        if file_size - self._data_start >= _footer.size:
+            f.seek(-_footer.size, os.SEEK_END)
+            index_offset, tag = _footer.unpack(f.read(_footer.size))
+            if tag == _footer_tag and self._data_start <= index_offset <= file_size - _footer.size:
+                f.seek(index_offset)
+                try:
+                    index = json.loads(f.read(file_size - _footer.size - index_offset).decode())
+                except ValueError:
+                    pass
+                else:
+                    chunks = {
+                        tuple(int(k) for k in key.split(",")): value
+                        for key, value in index.items()
+                    }
+                    return chunks, index_offset
+
+        chunks = dict()
+        offset = self._data_start
+        f.seek(offset)
+        while offset + _record.size <= file_size:
+            tag, cam_id, block, length, low, high = _record.unpack(f.read(_record.size))
+            if tag != _record_tag or offset + _record.size + length > file_size:
+                break
+            chunks[(cam_id, block)] = [offset + _record.size, length, low, high]
+            offset += _record.size + length
+            f.seek(offset)
+        return chunks, offset
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getstate__(self):
+        # file handles and decompressed chunks are not shared with other processes
+        state = self.__dict__.copy()
+        state["_file"] = None
+        state["_cache"] = OrderedDict()
+        return state
+
+    def _chunk_shape(self, block):
+        num_images = min(self.block_size, self.shape[1] - block * self.block_size)
+        return (num_images,) + self.shape[2:]
+
+    def _read_chunk(self, cam_id, block):
+        key = (cam_id, block)
+        if key in self._pending:
+            return self._pending[key][0]
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        if key not in self._chunks:
+            chunk = np.zeros(self._chunk_shape(block), dtype=np.float32)
+            chunk.setflags(write=False)
+            return chunk
+
+        offset, length, low, high = self._chunks[key]
+        if self._file is None:
+            self._file = open(self.path, "rb")
+        self._file.seek(offset)
+        buf = zlib.decompress(self._file.read(length))
+        chunk = np.frombuffer(buf, dtype=self.dtype).reshape(self._chunk_shape(block))
+        if self.dtype == "uint8":
+            chunk = chunk.astype(np.float32) * np.float32((high - low) / 255.0) + np.float32(low)
+        else:
+            chunk = chunk.astype(np.float32)
+        # images are returned as views of the cached chunk, which must not be modified
+        chunk.setflags(write=False)
+
+        self._cache[key] = chunk
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return chunk
+
+    def get_image(self, cam_id, img_id):
+        """Heatmaps of one image, read only num_joints x height x width float32 array"""
+        block, i = divmod(int(img_id), self.block_size)
+        key = (int(cam_id), block)
+        if key in self._pending:
+            # chunks being written change with the next writes
+            return self._pending[key][0][i].copy()
+        return self._read_chunk(*key)[i]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) >= 2 and np.ndim(key[0]) == 0 and np.ndim(key[1]) == 0:
+            return self.get_image(key[0], key[1])[key[2:]]
+        if len(key) == len(self.shape) and all(
+            np.asarray(k).dtype.kind in "iu" for k in key
+        ):
+            return self._gather(key)
+        raise NotImplementedError(
+            "Heatmap store supports hm[cam, img, ...] and elementwise integer indexing"
+        )
+
+    def _gather(self, key):
+        """Elementwise indexing, hm[cam_ids, img_ids, joint_ids, rows, cols] with integer arrays"""
+        key = np.broadcast_arrays(*[np.asarray(k) for k in key])
+        out = np.zeros(key[0].shape, dtype=np.float32)
+        cam_id, img_id = key[0].ravel(), key[1].ravel()
+        block, i = np.divmod(img_id, self.block_size)
+        chunk_id = cam_id * (self.shape[1] // self.block_size + 1) + block
+        order = np.argsort(chunk_id, kind="stable")
+        bounds = np.flatnonzero(np.diff(chunk_id[order])) + 1
+        for group in np.split(order, bounds):
+            if group.size == 0:
+                continue
+            chunk = self._read_chunk(int(cam_id[group[0]]), int(block[group[0]]))
+            out.flat[group] = chunk[(i[group],) + tuple(k.ravel()[group] for k in key[2:])]
+        return out
+
+    def __setitem__(self, key, value):
+        """Writes whole images, hm[cam_ids, img_ids] = heatmaps or hm[cam_ids, img_ids, :] = heatmaps"""
+        if not self._writable:
+            raise IOError("Heatmap store {} is read only".format(self.path))
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k != slice(None) for k in key[2:]):
+            raise NotImplementedError("Heatmap store only writes whole images")
+        cam_id, img_id = np.broadcast_arrays(np.asarray(key[0]), np.asarray(key[1]))
+        value = np.broadcast_to(value, cam_id.shape + self.shape[2:]).reshape(
+            (-1,) + self.shape[2:]
+        )
+
+        for c, n, v in zip(cam_id.ravel(), img_id.ravel(), value):
+            block, i = divmod(int(n), self.block_size)
+            chunk_key = (int(c), block)
+            if chunk_key not in self._pending:
+                self._pending[chunk_key] = [self._read_chunk(*chunk_key).copy(), 0]
+                self._cache.pop(chunk_key, None)
+            self._pending[chunk_key][0][i] = v
+            self._pending[chunk_key][1] += 1
+            if self._pending[chunk_key][1] == self._pending[chunk_key][0].shape[0]:
+                self._write_chunk(chunk_key)
+
+    def _write_chunk(self, chunk_key):
+        chunk = self._pending.pop(chunk_key)[0]
+        low = high = 0.0
+        if self.dtype == "uint8":
+            low, high = float(chunk.min()), float(chunk.max())
+            scale = 255.0 / (high - low) if high > low else 0.0
+            data = np.rint((chunk - low) * scale).astype(np.uint8)
+        else:
+            data = chunk.astype(np.float16)
+        buf = zlib.compress(np.ascontiguousarray(data).tobytes(), 1)
+
+        with open(self.path, "r+b") as f:
+            f.seek(self._data_end)
+            f.write(_record.pack(_record_tag, chunk_key[0], chunk_key[1], len(buf), low, high))
+            f.write(buf)
+            f.truncate()
+        self._chunks[chunk_key] = [self._data_end + _record.size, len(buf), low, high]
+        self._data_end += _record.size + len(buf)
+
+    def flush(self):
+        """Compresses the partially written chunks and writes the index"""
+        if not self._writable:
+            return
+        for chunk_key in list(self._pending.keys()):
+            self._write_chunk(chunk_key)
+        index = {"{},{}".format(*k): v for k, v in self._chunks.items()}
+        with open(self.path, "r+b") as f:
+            f.seek(self._data_end)
+            f.write(json.dumps(index).encode())
+            f.write(_footer.pack(self._data_end, _footer_tag))
+            f.truncate()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def open_heatmap(path, shape):
+    """
+    Reads a heatmap store, the peaks written by save_heatmap_peaks,
+    or a float32 memmap of the given shape written by older versions
+    """
+    if is_heatmap_peaks(path):
+        return PeakHeatmap(path)
+    if HeatmapStore.is_store(path):
+        return HeatmapStore(path)
+    return np.memmap(filename=path, mode="r", shape=shape, dtype="float32")
+
+
+def create_heatmap(path, shape, dtype="uint8"):
+    """Heatmap array to be written by the 2d pose estimation, a float32 memmap if dtype is float32"""
+    if dtype == "float32":
+        return np.memmap(path, dtype="float32", mode="w+", shape=shape)
+    return HeatmapStore.create(path, shape, dtype=dtype)
+
+
+def find_peaks(hm, num_peak, radius=2):
+    """
+    Largest num_peak local maxima of each heatmap, and the patch of radius pixels around them.
+    hm: ... x height x width array
+    returns ... x num_peak x 2 int16 array of (row, col), -1 when there are fewer peaks,
+    and ... x num_peak x (2 * radius + 1) x (2 * radius + 1) float16 array of patches
+    """
+    from scipy.ndimage import maximum_filter
+
+    lead, (h, w) = hm.shape[:-2], hm.shape[-2:]
+    hm = hm.reshape((-1, h, w)).astype(np.float32)
+    # same local maxima as hm_to_pred with min_distance=1 and threshold_abs=0
+    is_peak = (hm == maximum_filter(hm, size=(1, 3, 3), mode="constant", cval=-np.inf)) & (hm > 0)
+    score = np.where(is_peak, hm, -np.inf).reshape(hm.shape[0], -1)
+    top = np.argpartition(-score, num_peak - 1, axis=1)[:, :num_peak]
+    top = np.take_along_axis(top, np.argsort(-np.take_along_axis(score, top, 1), axis=1), 1)
+    valid = np.isfinite(np.take_along_axis(score, top, 1))
+
+    row, col = np.divmod(top, w)
+    offset = np.arange(-radius, radius + 1)
+    padded = np.pad(hm, ((0, 0), (radius, radius), (radius, radius)))
+    patches = padded[
+        np.arange(hm.shape[0])[:, None, None, None],
+        (row + radius)[:, :, None, None] + offset[:, None],
+        (col + radius)[:, :, None, None] + offset[None, :],
+    ]
+    patches[~valid] = 0
+
+    peaks = np.stack([row, col], axis=-1).astype(np.int16)
+    peaks[~valid] = -1
+    size = 2 * radius + 1
+    return (
+        peaks.reshape(lead + (num_peak, 2)),
+        patches.astype(np.float16).reshape(lead + (num_peak, size, size)),
+    )
+
+
+def save_heatmap_peaks(hm, path, num_peak, radius=2):
+    """
+    Writes the local maxima of every heatmap of hm, see find_peaks, to the folder path.
+    This is a few hundred times smaller than the heatmaps and can be read back with PeakHeatmap.
+    The peaks and patches are written block by block to memory mapped .npy files.
+    """
+    from numpy.lib.format import open_memmap
+
+    num_cameras, num_images = hm.shape[:2]
+    size = 2 * radius + 1
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "shape.npy"), np.array(hm.shape))
+    peaks = open_memmap(
+        os.path.join(path, "peaks.npy"), mode="w+", dtype=np.int16,
+        shape=tuple(hm.shape[:3]) + (num_peak, 2),
+    )
+    patches = open_memmap(
+        os.path.join(path, "patches.npy"), mode="w+", dtype=np.float16,
+        shape=tuple(hm.shape[:3]) + (num_peak, size, size),
+    )
+    block_size = 16
+    for cam_id in range(num_cameras):
+        for start in range(0, num_images, block_size):
+            img_id = np.arange(start, min(start + block_size, num_images))
+            block = np.stack([hm[cam_id, i] for i in img_id])
+            peaks[cam_id, img_id], patches[cam_id, img_id] = find_peaks(block, num_peak, radius)
+        peaks.flush()
+        patches.flush()
+    del peaks, patches
+
+
+def is_heatmap_peaks(path):
+    return os.path.isfile(os.path.join(path, "peaks.npy"))
+
+
+class PeakHeatmap:
+    """
+    Heatmaps rebuilt from the folder written by save_heatmap_peaks, indexed like HeatmapStore.
+    Pixels outside the patches around the peaks read as zeros.
+    The peaks and patches are memory mapped, pickling only keeps the path.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.shape = tuple(int(s) for s in np.load(os.path.join(path, "shape.npy")))
+        self._open()
+
+    def _open(self):
+        self.peaks = np.load(os.path.join(self.path, "peaks.npy"), mmap_mode="r")
+        self.patches = np.load(os.path.join(self.path, "patches.npy"), mmap_mode="r")
+        self.radius = self.patches.shape[-1] // 2
+
+    def __getstate__(self):
+        return dict(path=self.path, shape=self.shape)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def get_image(self, cam_id, img_id):
+        """Heatmaps of one image, num_joints x height x width float32 array"""
+        h, w = self.shape[-2:]
+        peaks = self.peaks[cam_id, img_id].astype(int)  # joints x num_peak x 2
+        patches = self.patches[cam_id, img_id]
+        offset = np.arange(-self.radius, self.radius + 1)
+        row = peaks[:, :, 0, None, None] + offset[:, None]
+        col = peaks[:, :, 1, None, None] + offset[None, :]
+        j_id = np.broadcast_to(
+            np.arange(peaks.shape[0])[:, None, None, None], patches.shape
+        )
+        mask = (peaks[:, :, 0, None, None] >= 0) & (row >= 0) & (row < h) & (col >= 0) & (col < w)
+
+        hm = np.zeros(self.shape[2:], dtype=np.float32)
+        hm[j_id[mask], np.broadcast_to(row, mask.shape)[mask], np.broadcast_to(col, mask.shape)[mask]] = patches[mask]
+        return hm
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) >= 2 and np.ndim(key[0]) == 0 and np.ndim(key[1]) == 0:
+            return self.get_image(int(key[0]), int(key[1]))[key[2:]]
+        if len(key) == len(self.shape) and all(
+            np.asarray(k).dtype.kind in "iu" for k in key
+        ):
+            return self._gather(key)
+        raise NotImplementedError(
+            "Peak heatmaps support hm[cam, img, ...] and elementwise integer indexing"
+        )
+
+    def _gather(self, key):
+        """Elementwise indexing, values under the patches or zero"""
+        cam_id, img_id, j_id, row, col = [
+            k.ravel() for k in np.broadcast_arrays(*[np.asarray(k) for k in key])
+        ]
+        peaks = self.peaks[cam_id, img_id, j_id].astype(int)  # m x num_peak x 2
+        dr = row[:, None] - peaks[:, :, 0] + self.radius
+        dc = col[:, None] - peaks[:, :, 1] + self.radius
+        size = 2 * self.radius + 1
+        inside = (peaks[:, :, 0] >= 0) & (dr >= 0) & (dr < size) & (dc >= 0) & (dc < size)
+
+        k = np.argmax(inside, axis=1)
+        m = np.arange(k.size)
+        values = self.patches[cam_id, img_id, j_id, k, dr[m, k].clip(0, size - 1), dc[m, k].clip(0, size - 1)]
+        out = np.where(inside[m, k], values.astype(np.float32), 0)
+        return out.reshape(np.broadcast(*[np.asarray(k) for k in key]).shape)
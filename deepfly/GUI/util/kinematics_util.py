@@ -0,0 +1,68 @@
+import numpy as np
+
+from ..Config import config
+
+
+def angle_three_points_batch(a, b, c):
+    """
+    Angle at b between b->a and b->c, for ... x 3 arrays, nan where a or c is b
+    """
+    ba = a - b
+    bc = c - b
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cosine_angle = np.sum(ba * bc, axis=-1) / (
+            np.linalg.norm(ba, axis=-1) * np.linalg.norm(bc, axis=-1)
+        )
+        return np.arccos(cosine_angle)
+
+
+def pose3d_to_angle(data, skeleton=None):
+    """
+    Joint angles of the poses data, num_images x num_joints x 3 array.
+    The angle of joint j is taken between joints j - 1, j and j + 1, see skeleton.angle_joint_id,
+    other joints, and undefined angles, are 0.
+    returns num_images x num_joints float32 array
+    """
+    if skeleton is None:
+        skeleton = config["skeleton"]
+    data = np.asarray(data)
+    data_angle = np.zeros(data.shape[:2], dtype=np.float32)
+    joint_id = skeleton.angle_joint_id[skeleton.angle_child_id < data.shape[1]]
+    data_angle[:, joint_id] = angle_three_points_batch(
+        data[:, joint_id - 1], data[:, joint_id], data[:, joint_id + 1]
+    )
+    data_angle[np.logical_or(np.isnan(data_angle), np.isinf(data_angle))] = 0
+
+    return data_angle
+
+
+def limb_angle_id(skeleton=None):
+    """
+    Joints of the angles of each limb, those whose previous and next joints are on the same limb.
+    For the fly, these are the coxa-femur, femur-tibia and tibia-tarsus joints of the six legs.
+    returns dictionary limb_id -> joint ids, proximal to distal, for the limbs with at least one angle
+    """
+    if skeleton is None:
+        skeleton = config["skeleton"]
+    joint_id = skeleton.angle_joint_id
+    limb = skeleton.limb_id_arr
+    same_limb = (limb[skeleton.angle_parent_id] == limb[joint_id]) & (
+        limb[skeleton.angle_child_id] == limb[joint_id]
+    )
+    return {
+        int(limb_id): joint_id[same_limb & (limb[joint_id] == limb_id)]
+        for limb_id in np.unique(limb[joint_id[same_limb]])
+    }
+
+
+def pose3d_to_limb_angle(data, skeleton=None):
+    """
+    Joint angles of each limb, see limb_angle_id, as used by the behavior classifiers.
+    data: num_images x num_joints x 3 array
+    returns dictionary limb_id -> num_images x num_limb_angles float32 array
+    """
+    data_angle = pose3d_to_angle(data, skeleton)
+    return {
+        limb_id: data_angle[:, joint_id]
+        for limb_id, joint_id in limb_angle_id(skeleton).items()
+    }
@@ -26,22 +26,30 @@ def calibrate_calc(drosophAnnot, min_img_id, max_img_id):
 
     # ugly hack to temporarly incorporate manual corrections to calibration
     c = 0
+    corrected = dict()
     for cam_id in range(config["num_cameras"]):
+        corrected[cam_id] = np.zeros(drosophAnnot.state.num_images, dtype=bool)
         for img_id in range(drosophAnnot.state.num_images):
             if drosophAnnot.state.db.has_key(cam_id, img_id):
                 pt = drosophAnnot.state.db.read(cam_id, img_id) * config["image_shape"]
                 drosophAnnot.camNetAll[cam_id].points2d[img_id, :] = pt
+                drosophAnnot.camNetAll[cam_id].invalidate()
+                corrected[cam_id][img_id] = True
                 c += 1
     print("Calibration: replaced {} points from manuall correction".format(c))
 
     # keep the pts only in the range
     for cam in drosophAnnot.camNetAll:
         cam.points2d = cam.points2d[min_img_id:max_img_id, :]
+    corrected = {cam_id: corr[min_img_id:max_img_id] for cam_id, corr in corrected.items()}
 
+    # heatmaps are still indexed from the first image
     drosophAnnot.camNetLeft.triangulate()
-    drosophAnnot.camNetLeft.bundle_adjust(cam_id_list=(0,1,2), unique=False, prior=True)
+    drosophAnnot.camNetLeft.bundle_adjust(cam_id_list=(0,1,2), unique=False, prior=True, max_points=config["calib_num_points"],
+                                          img_id_offset=min_img_id, corrected=corrected)
     drosophAnnot.camNetRight.triangulate()
-    drosophAnnot.camNetRight.bundle_adjust(cam_id_list=(0,1,2), unique=False, prior=True)
+    drosophAnnot.camNetRight.bundle_adjust(cam_id_list=(0,1,2), unique=False, prior=True, max_points=config["calib_num_points"],
+                                           img_id_offset=min_img_id, corrected=corrected)
     #drosophAnnot.camNetAll.triangulate()
     #drosophAnnot.camNetAll.bundle_adjust(cam_id_list=range(config["num_cameras"]), unique=False, prior=True)
     #drosophAnnot.camNetAll.triangulate()
@@ -1,6 +1,7 @@
 import numpy as np
 
-from .cv_util import triangulate_linear
+from .ba_util import project_batch
+from .cv_util import triangulate_linear, nview_linear_triangulation_batch
 from ..Config import  config
 
 
@@ -56,6 +57,71 @@ def probability_heatmap(cam_list, img_id, j_id, points2d, image_shape=(480, 960)
     return prob
 
 
+def triangulate_batch(cam_list, points2d):
+    """
+    Batched triangulate_linear, one point from every row of observations.
+    points2d: n x len(cam_list) x 2 array in pixels
+    returns nx3 array
+    """
+    proj = np.array([cam.P for cam in cam_list])
+    mask = np.ones((points2d.shape[0], 1, len(cam_list)), dtype=bool)
+    return nview_linear_triangulation_batch(proj, points2d[:, np.newaxis], mask)[:, 0]
+
+
+def project_cameras(cam_list, points3d):
+    """
+    Projects every point with every camera, same as Camera.project.
+    points3d: nx3 array
+    returns n x len(cam_list) x 2 array in pixels
+    """
+    rvec = np.array([np.squeeze(cam.rvec) for cam in cam_list], dtype=float)
+    tvec = np.array([np.squeeze(cam.tvec) for cam in cam_list], dtype=float)
+    intr = np.array([cam.intr for cam in cam_list], dtype=float)
+    distort = np.array([np.squeeze(cam.distort) for cam in cam_list], dtype=float)
+    camera_indices = np.tile(np.arange(len(cam_list)), points3d.shape[0])
+    points2d = project_batch(
+        np.repeat(points3d, len(cam_list), axis=0), rvec, tvec, intr, distort, camera_indices
+    )
+    return points2d.reshape(points3d.shape[0], len(cam_list), 2)
+
+
+def energy_drosoph_batch(
+    cam_list,
+    hm_list,
+    points2d,
+    image_shape=config["image_shape"],
+    hm_shape=config["heatmap_shape"],
+):
+    """
+    energy_drosoph of n proposals at once
+    hm_list: heatmaps of the joint, one per camera
+    points2d: n x len(cam_list) x 2 array, normalized observations
+    returns the nx3 triangulated points, the reprojection errors and the heatmap probabilities
+    """
+    p3d = triangulate_batch(cam_list, points2d * image_shape)
+
+    # same as error_reprojection, from integer pixel coordinates
+    points2d_int = (points2d * image_shape).astype(int)
+    err_proj = project_cameras(cam_list, triangulate_batch(cam_list, points2d_int)) - points2d_int
+    err_proj = np.mean(np.abs(err_proj), axis=(1, 2))
+
+    prob_heatm = probability_heatmap_batch(hm_list, (points2d * hm_shape).astype(int))
+    return p3d, err_proj, prob_heatm
+
+
+def probability_heatmap_batch(hm_list, points2d, eps=0.1):
+    """
+    probability_heatmap of n proposals at once
+    points2d: n x len(hm_list) x 2 array, pixel space
+    """
+    prob = np.ones(points2d.shape[0])
+    for hm, p in zip(hm_list, np.swapaxes(points2d, 0, 1)):
+        inside = (p[:, 1] < hm.shape[0]) & (p[:, 0] < hm.shape[1]) & (p[:, 0] >= 0) & (p[:, 1] >= 0)
+        value = hm[np.where(inside, p[:, 1], 0), np.where(inside, p[:, 0], 0)]
+        prob *= eps + np.where(inside, value, 0)
+    return prob
+
+
 def error_reprojection(cam_list, points2d):
     """
     points2d: nx2 array containing projections
@@ -10,6 +10,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib.ticker import FuncFormatter, MultipleLocator
 from ..Config import config
+from .kinematics_util import pose3d_to_angle
 
 
 class LowPassFilter(object):
@@ -76,6 +77,64 @@ class OneEuroFilter(object):
         return self.__x(x, timestamp, alpha=self.__alpha(cutoff))
 
 
+class OneEuroFilterArray(object):
+    """
+    OneEuroFilter applied elementwise to arrays, filters all joints and axes with one call per frame.
+    Same output as one OneEuroFilter for each element.
+    """
+
+    def __init__(self, freq, mincutoff=1.0, beta=0.0, dcutoff=1.0):
+        if freq <= 0:
+            raise ValueError("freq should be >0")
+        if mincutoff <= 0:
+            raise ValueError("mincutoff should be >0")
+        if dcutoff <= 0:
+            raise ValueError("dcutoff should be >0")
+        self.__freq = float(freq)
+        self.__mincutoff = float(mincutoff)
+        self.__beta = float(beta)
+        self.__dcutoff = float(dcutoff)
+        self.__x = self.__s = self.__edx = None
+        self.__lasttime = None
+
+    def __alpha(self, cutoff):
+        te = 1.0 / self.__freq
+        tau = 1.0 / (2 * math.pi * cutoff)
+        return 1.0 / (1.0 + tau / te)
+
+    def __call__(self, x, timestamp=None):
+        x = np.asarray(x, dtype=np.float64)
+        if self.__lasttime and timestamp:
+            self.__freq = 1.0 / (timestamp - self.__lasttime)
+        self.__lasttime = timestamp
+        if self.__x is None:
+            # first value is returned as is, and the variation starts at 0
+            self.__edx = np.zeros_like(x)
+            self.__s = x
+        else:
+            dx = (x - self.__x) * self.__freq
+            alpha = self.__alpha(self.__dcutoff)
+            self.__edx = alpha * dx + (1.0 - alpha) * self.__edx
+            alpha = self.__alpha(self.__mincutoff + self.__beta * np.abs(self.__edx))
+            self.__s = alpha * x + (1.0 - alpha) * self.__s
+        self.__x = x
+        return self.__s
+
+
+def _filter_time_series(pts, filter_indices, axes, config_oneuro, timestamps):
+    """Filters pts[:, filter_indices, :axes] over the first axis, the remaining values are copied"""
+    filter_indices = np.unique(np.asarray(filter_indices, dtype=int))
+    pts_after = pts.copy()
+    if pts.shape[0] == 0 or filter_indices.size == 0:
+        return pts_after
+    f = OneEuroFilterArray(**config_oneuro)
+    for i in range(pts.shape[0]):
+        pts_after[i, filter_indices, :axes] = f(
+            pts[i, filter_indices, :axes], timestamps[i]
+        )
+    return pts_after
+
+
 def filter_batch(pts, filter_indices=None, config_oneuro=None, freq=None):
     from ..Config import config
     assert pts.shape[-1] == 2 or pts.shape[-1] == 3
@@ -89,30 +148,18 @@ def filter_batch(pts, filter_indices=None, config_oneuro=None, freq=None):
             "dcutoff": 1.0,  # this one should be ok
         }
     if freq is not None:
-        config_oneuro["freq"] = freq
-
-    f = [
-        [OneEuroFilter(**config_oneuro) for j in range(pts.shape[-1])]
-        for i in range(config["skeleton"].num_joints)
-    ]
-    timestamp = 0.0  # seconds
-    pts_after = np.zeros_like(pts)
-    for i in range(pts.shape[0]):
-        for j in range(pts.shape[1]):
-            if j in filter_indices:
-                pts_after[i, j, 0] = f[j][0](pts[i, j, 0], (i + 1) * 0.1)
-                pts_after[i, j, 1] = f[j][1](pts[i, j, 1], (i + 1) * 0.1)
-                pts_after[i, j, 2] = f[j][2](pts[i, j, 2], (i + 1) * 0.1)
-
-            else:
-                pts_after[i, j] = pts[i, j]
-    return pts_after
+        config_oneuro = dict(config_oneuro, freq=freq)
+
+    timestamps = (np.arange(pts.shape[0]) + 1) * 0.1  # seconds
+    return _filter_time_series(
+        pts, filter_indices, pts.shape[-1], config_oneuro, timestamps
+    )
 
 
 def filter_batch_2d(pts, filter_indices=None, config=None, freq=None):
     assert pts.shape[-1] == 2 or pts.shape[-1] == 3
     if filter_indices is None:
-        filter_indices = np.arange(config["skeleton"].num_joints)
+        filter_indices = np.arange(pts.shape[1])
     if config is None:
         config = {
             "freq": 100,  # Hz
@@ -121,22 +168,10 @@ def filter_batch_2d(pts, filter_indices=None, config=None, freq=None):
             "dcutoff": 1.0,  # this one should be ok
         }
     if freq is not None:
-        config["freq"] = freq
-
-    f = [
-        [OneEuroFilter(**config) for j in range(pts.shape[-1])]
-        for i in range(config["skeleton"].num_joints)
-    ]
-    timestamp = 0.0  # seconds
-    pts_after = np.zeros_like(pts)
-    for i in range(pts.shape[0]):
-        for j in range(pts.shape[1]):
-            if j in filter_indices:
-                pts_after[i, j, 0] = f[j][0](pts[i, j, 0], i * 0.1)
-                pts_after[i, j, 1] = f[j][1](pts[i, j, 1], i * 0.1)
-            else:
-                pts_after[i, j] = pts[i, j]
-    return pts_after
+        config = dict(config, freq=freq)
+
+    timestamps = np.arange(pts.shape[0]) * 0.1  # seconds
+    return _filter_time_series(pts, filter_indices, 2, config, timestamps)
 
 
 def draw_time_series(
@@ -228,65 +263,55 @@ def angle_three_points(a, b, c):
     return angle
 
 
-def pose3d_to_angle(data, skeleton=config["skeleton"]):
-    data_angle = np.zeros((data.shape[0], data.shape[1]), dtype=np.float32)
-    for img_id in range(data.shape[0]):
-        for j_id in range(1, data.shape[1] - 1):
-            if "fly" in config["name"] and (
-                config["skeleton"].is_tracked_point(
-                    j_id, config["skeleton"].Tracked.TARSUS_TIP
-                )
-                or config["skeleton"].is_tracked_point(
-                    j_id, config["skeleton"].Tracked.STRIPE
-                )
-                or config["skeleton"].is_tracked_point(
-                    j_id, config["skeleton"].Tracked.ANTENNA
-                )
-            ):
-                continue
-            data_angle[img_id, j_id] = angle_three_points(
-                data[img_id, j_id - 1, :],
-                data[img_id, j_id, :],
-                data[img_id, j_id + 1, :],
-            )
-            data_angle[img_id, j_id] = angle_three_points(
-                data[img_id, j_id - 1, :],
-                data[img_id, j_id, :],
-                data[img_id, j_id + 1, :],
-            )
-            data_angle[img_id, j_id] = angle_three_points(
-                data[img_id, j_id - 1, :],
-                data[img_id, j_id, :],
-                data[img_id, j_id + 1, :],
-            )
-    data_angle[np.logical_or(np.isnan(data_angle), np.isinf(data_angle))] = 0
+def _rolling_std(x, window_size, axis=0):
+    """Standard deviation of x[s:s + window_size] for every start s along axis, with cumulative sums"""
+    x = np.moveaxis(x, axis, 0)
+    x = x - x.mean(axis=0)  # keeps the cumulative sums small
+    zero = np.zeros((1,) + x.shape[1:])
+    s1 = np.concatenate([zero, np.cumsum(x, axis=0)])
+    s2 = np.concatenate([zero, np.cumsum(x ** 2, axis=0)])
+    mean = (s1[window_size:] - s1[:-window_size]) / window_size
+    var = (s2[window_size:] - s2[:-window_size]) / window_size - mean ** 2
+    return np.moveaxis(np.sqrt(np.maximum(var, 0)), 0, axis)
 
-    return data_angle
 
+def _window_gaussian_weights(window_size, sigma, center):
+    """
+    Weights w such that np.dot(w, window) equals
+    gaussian_filter1d(window, sigma, mode="nearest")[center] for any window of length window_size
+    """
+    from scipy.ndimage import gaussian_filter1d
 
-def smooth_pose2d(points2d, window_size=20, pad=20, std_thr=5):
-    from scipy.ndimage.filters import gaussian_filter1d
+    return gaussian_filter1d(
+        np.eye(window_size), sigma=sigma, axis=0, mode="nearest"
+    )[center]
 
+
+def smooth_pose2d(points2d, window_size=20, pad=20, std_thr=5):
+    """
+    Smooths each joint coordinate with a gaussian of sigma 7 where it is still,
+    std under std_thr over the window_size frames around it, and leaves it where it moves.
+    The gaussian is applied to the window only, its values outside the window are the window edges.
+    """
+    from scipy.ndimage import correlate1d
+
+    half = window_size // 2
     points2d_filter = points2d.copy()
+    if points2d.shape[0] == 0:
+        return points2d_filter
     points2d_pad = np.zeros(
-        (points2d.shape[0] + 2 * pad, points2d.shape[1], points2d.shape[2])
+        (points2d.shape[0] + 2 * pad, points2d.shape[1], 2)
     )
-    points2d_pad[pad:-pad, :] = points2d.copy()
-    points2d_pad[:pad, :] = points2d[0, :]
-    points2d_pad[-pad:, :] = points2d[-1, :]
-    for img_id in range(20, points2d.shape[0] + 20):
-        for j in range(points2d.shape[1]):
-            for d in range(2):
-                segment_std = segment_smooth = points2d_pad[
-                    img_id - window_size // 2 : img_id + window_size // 2, j, d
-                ]
-                std = np.std(segment_std)
-                if std < std_thr:
-                    sigma = 7
-                else:
-                    sigma = 0.1
-                filtered = gaussian_filter1d(
-                    segment_smooth, sigma=sigma, mode="nearest"
-                )[window_size // 2]
-                points2d_filter[img_id - pad, j, d] = filtered
+    points2d_pad[pad:-pad] = points2d[:, :, :2]
+    points2d_pad[:pad] = points2d[0, :, :2]
+    points2d_pad[-pad:] = points2d[-1, :, :2]
+
+    # window of frame img_id is points2d_pad[img_id + pad - half: img_id + pad + half]
+    start = np.arange(points2d.shape[0]) + pad - half
+    std = _rolling_std(points2d_pad, 2 * half)[start]
+    filtered = dict()
+    for sigma in (7, 0.1):
+        weights = _window_gaussian_weights(2 * half, sigma, half)
+        filtered[sigma] = correlate1d(points2d_pad, weights, axis=0)[start + half]
+    points2d_filter[:, :, :2] = np.where(std < std_thr, filtered[7], filtered[0.1])
     return points2d_filter
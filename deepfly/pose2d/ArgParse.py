@@ -246,6 +246,62 @@ def add_arguments(parser):
         "--carry",
         action="store_true",
     )
+    # inference
+    parser.add_argument(
+        "--exported",
+        default=None,
+        type=str,
+        metavar="PATH",
+        help="run an exported network, see pose2d/export.py, instead of the checkpoint",
+    )
+    parser.add_argument(
+        "--device",
+        default="auto",
+        choices=["auto", "cpu", "cuda"],
+        help="device running the network, auto picks cuda when available",
+    )
+    parser.add_argument(
+        "--num-threads",
+        default=0,
+        type=int,
+        metavar="N",
+        dest="num_threads",
+        help="number of cpu threads for inference (default: 0, let torch decide)",
+    )
+    parser.add_argument(
+        "--exit-stack",
+        default=None,
+        type=int,
+        metavar="N",
+        dest="exit_stack",
+        help="run only the first N stacks during inference (default: all)",
+    )
+    parser.add_argument(
+        "--exit-tol",
+        default=None,
+        type=float,
+        metavar="PX",
+        dest="exit_tol",
+        help="stop inference once heatmap peaks of consecutive stacks move at most PX heatmap pixels, "
+        "decided per batch, disabled on several gpus",
+    )
+    parser.add_argument(
+        "--subpixel",
+        action="store_true",
+        help="refine the heatmap peaks by a quarter pixel towards the higher neighbour",
+    )
+    parser.add_argument(
+        "--channels-last",
+        action="store_true",
+        dest="channels_last",
+        help="use channels_last memory format for inference",
+    )
+    parser.add_argument(
+        "--precision",
+        default="fp32",
+        choices=["fp32", "bf16"],
+        help="precision of the network activations during inference",
+    )
     parser.add_argument("--inplanes", default=64, type=int, metavar="N")
     parser.add_argument("--stride", default=2, type=int, metavar="N")
     parser.add_argument("--sigma", default=1, type=int)
@@ -6,6 +6,7 @@ from deepfly.GUI.util.os_util import *
 from deepfly.pose2d.utils.osutils import isfile
 from deepfly.pose2d.utils.transforms import *
 from deepfly.GUI.Config import config
+from deepfly.GUI.DB import PoseDB
 from logging import getLogger
 import logging
 import glob
@@ -96,6 +97,8 @@ class Drosophila(data.Dataset):
         unlabeled=None,
         num_classes=config["num_predict"],
         max_img_id=None,
+        normalize=True,
+        inference=False,
     ):
         self.train = train
         self.data_folder = data_folder  # root image folders
@@ -111,6 +114,8 @@ class Drosophila(data.Dataset):
         self.unlabeled = unlabeled
         self.num_classes = num_classes
         self.max_img_id = max_img_id
+        self.normalize = normalize  # False when the network subtracts the mean itself
+        self.inference = inference  # only the images and their ids, no targets
         self.cidread2cid = dict()
 
         self.session_id_train_list = session_id_train_list
@@ -119,6 +124,7 @@ class Drosophila(data.Dataset):
             not self.evaluation or not self.augmentation
         )  # self eval then not augmentation
         assert not self.unlabeled or evaluation  # if unlabeled then evaluation
+        assert not self.inference or not self.augmentation
 
         manual_path_list = ["/data/paper/"]
 
@@ -179,7 +185,7 @@ class Drosophila(data.Dataset):
                     )
                 )
             for path in pose_corr_path_list:
-                d = pickle.load(open(path, "rb"))
+                d = PoseDB.load(path)
                 folder_name = d["folder"]
                 key_folder_name = folder_name
                 if folder_name not in self.cidread2cid:
@@ -356,7 +362,40 @@ class Drosophila(data.Dataset):
         )
         return img_path
 
+    def _get_inference_item(self, index):
+        """Image at the network resolution and the ids of the image, there is no target"""
+        folder_name, img_name = (
+            self.annotation_key[index][FOLDER_NAME],
+            self.annotation_key[index][IMAGE_NAME],
+        )
+        cid_read, pose_id = parse_img_name(img_name)
+        cid = self.cidread2cid[folder_name][cid_read]
+        flip = cid in config["flip_cameras"] and ("data" in folder_name or ( "data" not in folder_name and self.unlabeled))
+
+        try:
+            img_norm = load_image_resized(
+                self.__get_image_path(folder_name, cid_read, pose_id), self.img_res, flip
+            )
+        except FileNotFoundError:
+            img_norm = load_image_resized(
+                self.__get_image_path(folder_name, cid_read, pose_id, pad=False), self.img_res, flip
+            )
+        if self.normalize:
+            img_norm = color_normalize(img_norm, self.mean, self.std)
+
+        meta = {
+            "folder_name": folder_name,
+            "image_name": img_name,
+            "index": index,
+            "cid": cid,
+            "cam_read_id": cid_read,
+            "pid": pose_id,
+        }
+        return img_norm, meta
+
     def __getitem__(self, index, batch_mode=True, temporal=False):
+        if self.inference:
+            return self._get_inference_item(index)
         folder_name, img_name = (
             self.annotation_key[index][FOLDER_NAME],
             self.annotation_key[index][IMAGE_NAME],
@@ -385,6 +424,7 @@ class Drosophila(data.Dataset):
         nparts = pts.size(0)
         assert (nparts == config["num_predict"])
 
+        camera_see_joint = config["skeleton"].camera_see_joint_arr[cid]
         joint_exists = np.zeros(shape=(nparts,), dtype=np.uint8)
         for i in range(nparts):
             # we convert to int as we cannot pass boolean from pytorch dataloader
@@ -395,10 +435,8 @@ class Drosophila(data.Dataset):
                     (0.01 < pts[i][0] < 0.99)
                     and (0.01 < pts[i][1] < 0.99)
                     and (
-                            config["skeleton"].camera_see_joint(cid, i)
-                            or config["skeleton"].camera_see_joint(
-                            cid, (i + config["num_predict"])
-                        )
+                            camera_see_joint[i]
+                            or camera_see_joint[i + config["num_predict"]]
                     )
                 )
                 else 0
@@ -406,8 +444,6 @@ class Drosophila(data.Dataset):
         if flip:
             img_orig = torch.from_numpy(fliplr(img_orig.numpy())).float()
             pts = shufflelr(pts, width=img_orig.size(2), dataset="drosophila")
-        print("img_orig       " + str(type(img_orig)))
-        print("self.img_res   " + str(self.img_res))
         img_norm = im_to_torch(scipy.misc.imresize(img_orig, self.img_res))
 
         # Generate ground truth heatmap
@@ -436,7 +472,8 @@ class Drosophila(data.Dataset):
         else:
             img_norm = img_norm
 
-        img_norm = color_normalize(img_norm, self.mean, self.std)
+        if self.normalize:
+            img_norm = color_normalize(img_norm, self.mean, self.std)
 
         if cid ==3 or cid==7:
             raise NotImplementedError
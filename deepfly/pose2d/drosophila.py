@@ -12,32 +12,40 @@ from torch.utils.data import DataLoader
 import torch.nn.parallel
 import torch.backends.cudnn as cudnn
 import torch.optim
+from torch.nn.modules.utils import consume_prefix_in_state_dict_if_present
 
 from deepfly.pose2d.progress.progress.bar import Bar, NoOutputBar
 from deepfly.pose2d.utils.logger import Logger, savefig
-from deepfly.pose2d.utils.evaluation import accuracy, AverageMeter, mse_acc
+from deepfly.pose2d.utils.evaluation import accuracy, AverageMeter, mse_acc, decode_heatmaps
 from deepfly.pose2d.utils.misc import save_checkpoint, save_dict
 from deepfly.pose2d.utils.osutils import isfile, join, find_leaf_recursive
 from deepfly.pose2d.utils.imutils import save_image, drosophila_image_overlay
 from deepfly.pose2d.ArgParse import create_parser
+from deepfly.pose2d.export import load_exported
 from deepfly.GUI.util.os_util import *
+from deepfly.GUI.util.heatmap_util import create_heatmap, save_heatmap_peaks
 import deepfly.pose2d.datasets
 import deepfly.pose2d.models as models
 from deepfly.pose2d.utils.osutils import mkdir_p, isdir
 import os
 from deepfly.pose2d.utils.misc import get_time, to_numpy
-from deepfly.GUI.Camera import Camera
 from deepfly.GUI.Config import config
 from pathlib import Path
 
 from logging import getLogger
 import logging
-import cv2
 
 import pdb
 
 best_acc = 0
 
+def get_device(args):
+    """Device running the network, cuda when available unless args.device says otherwise"""
+    if args.device == "auto":
+        return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    return torch.device(args.device)
+
+
 def weighted_mse_loss(inp, target, weights):
     out = (inp - target) ** 2
     out = out * weights.expand_as(out)
@@ -46,9 +54,14 @@ def weighted_mse_loss(inp, target, weights):
     return loss
 
 
-def main(args):
-    global best_acc
-
+def create_model(args, device, inference=None):
+    """
+    Builds the network described by args and loads the weights from args.resume.
+    inference: whether mpii weights are loaded whole to run predictions, rather than without
+    their output layers to be trained on, by default when args.unlabeled is set
+    """
+    if inference is None:
+        inference = bool(args.unlabeled)
     # create model
     getLogger('df3d').debug("Creating model '{}', stacks={}, blocks={}".format(
             args.arch, args.stacks, args.blocks
@@ -63,25 +76,21 @@ def main(args):
         init_stride=args.stride,
     )
 
-    model = torch.nn.DataParallel(model).cuda()
-    criterion = torch.nn.MSELoss(reduction='mean').cuda()  # deprecated: size_average=True
-    optimizer = torch.optim.RMSprop(
-        model.parameters(),
-        lr=args.lr,
-        momentum=args.momentum,
-        weight_decay=args.weight_decay,
-    )
-    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
-        optimizer, verbose=True, patience=5
-    )
+    if device.type == "cuda":
+        model = torch.nn.DataParallel(model).cuda()
+        if getattr(args, "exit_tol", None) is not None and len(model.device_ids) > 1:
+            getLogger('df3d').warning("Early exit with exit_tol is disabled when running on several gpus")
+    getLogger('df3d').debug("Total params: %.2fM" % (sum(p.numel() for p in model.parameters()) / 1000000.0))
 
     # optionally resume from a checkpoint
-    title = "Drosophila-" + args.arch
     if args.resume:
         if isfile(args.resume):
             getLogger('df3d').debug("Loading checkpoint '{}'".format(args.resume))
-            checkpoint = torch.load(args.resume)
-            if "mpii" in args.resume and not args.unlabeled:  # weights for sh trained on mpii dataset
+            checkpoint = torch.load(args.resume, map_location=device)
+            if not isinstance(model, torch.nn.DataParallel):
+                # checkpoints are saved from DataParallel models
+                consume_prefix_in_state_dict_if_present(checkpoint["state_dict"], "module.")
+            if "mpii" in args.resume and not inference:  # weights for sh trained on mpii dataset
                 getLogger('df3d').debug("Removing input/output layers")
                 ignore_weight_list_template = [
                     "module.score.{}.bias",
@@ -101,7 +110,7 @@ def main(args):
                 getLogger('df3d').debug(model.state_dict())
                 getLogger('df3d').debug(checkpoint["state_dict"])
                 model.load_state_dict(state, strict=False)
-            elif "mpii" in args.resume and args.unlabeled:
+            elif "mpii" in args.resume and inference:
                 model.load_state_dict(checkpoint['state_dict'], strict=False)
             else:
                 pretrained_dict = checkpoint["state_dict"]
@@ -125,6 +134,31 @@ def main(args):
             print("=> no checkpoint found at '{}'".format(args.resume))
             raise FileNotFoundError
 
+    return model
+
+
+def main(args):
+    global best_acc
+
+    device = get_device(args)
+    getLogger('df3d').debug("Running the network on {}".format(device))
+    if device.type == "cpu" and args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    if args.exported:
+        # the exported network subtracts the mean itself, see pose2d/export.py
+        getLogger('df3d').debug("Loading exported network '{}'".format(args.exported))
+        model, meta = load_exported(args.exported, device)
+        args.img_res = meta["image_shape"]
+        args.hm_res = meta["heatmap_shape"]
+        args.num_classes = meta["num_classes"]
+    else:
+        model = create_model(args, device)
+        if args.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+    criterion = torch.nn.MSELoss(reduction='mean').to(device)  # deprecated: size_average=True
+    title = "Drosophila-" + args.arch
+
     # prepare loggers
     if not args.unlabeled:
         logger = Logger(join(args.checkpoint, "log.txt"), title=title)
@@ -142,7 +176,6 @@ def main(args):
         )
 
     # cudnn.benchmark = True
-    getLogger('df3d').debug("Total params: %.2fM" % (sum(p.numel() for p in model.parameters()) / 1000000.0))
 
     if args.unlabeled:
         if args.unlabeled[0] == '/': #wtf why does it have a slash before it where did that come from?
@@ -170,39 +203,24 @@ def main(args):
                 unlabeled=unlabeled_folder,
                 num_classes=args.num_classes,
                 max_img_id=max_img_id,
+                normalize=not args.exported,
+                inference=True,
             ),
             batch_size=args.test_batch,
             shuffle=False,
             num_workers=args.workers,
-            pin_memory=False,
+            pin_memory=device.type == "cuda",
             drop_last=False,
+            **(dict(prefetch_factor=4, persistent_workers=False) if args.workers > 0 else dict())
         )
 
-        valid_loss, valid_acc, val_pred, val_score_maps, mse, jump_acc = validate(
-            unlabeled_loader, 0, model, criterion, args, save_path=unlabeled_folder
+        val_pred, val_score_maps = predict(
+            unlabeled_loader, model, args, save_path=unlabeled_folder
         )
         unlabeled_folder_replace = unlabeled_folder.replace("/", "-")
         getLogger('df3d').debug(f"val_score_maps have shape: {val_score_maps.shape}")
 
-        getLogger('df3d').debug("Saving Results, flipping heatmaps")
-        cid_to_reverse = config["flip_cameras"]  # camera id to reverse predictions and heatmaps
-        cidread2cid, cid2cidread = read_camera_order(os.path.join(unlabeled_folder, 'df3d'))
-        cid_read_to_reverse = [cid2cidread[cid] for cid in cid_to_reverse]
-        getLogger('df3d').debug(
-            "Flipping heatmaps for images with cam_id: {}".format(
-                cid_read_to_reverse
-            )
-        )
-        val_pred[cid_read_to_reverse, :, :, 0] = (
-            1 - val_pred[cid_read_to_reverse, :, :, 0]
-        )
-        for cam_id in cid_read_to_reverse:
-            for img_id in range(val_score_maps.shape[1]):
-                for j_id in range(val_score_maps.shape[2]):
-                    val_score_maps[cam_id, img_id, j_id, :, :] = cv2.flip(
-                        val_score_maps[cam_id, img_id, j_id, :, :], 1
-                    )
-
+        getLogger('df3d').debug("Saving Results")
         save_dict(
             val_pred,
             os.path.join(
@@ -213,8 +231,29 @@ def main(args):
             ),
         )
 
+        if config["heatmap_peaks"]:
+            save_heatmap_peaks(
+                val_score_maps,
+                os.path.join(
+                    args.data_folder,
+                    "{}".format(unlabeled_folder),
+                    args.output_folder,
+                    "peaks_{}".format(unlabeled_folder_replace),
+                ),
+                num_peak=config["heatmap_peaks"],
+            )
+
         getLogger('df3d').debug("Finished saving results")
     else:
+        optimizer = torch.optim.RMSprop(
+            model.parameters(),
+            lr=args.lr,
+            momentum=args.momentum,
+            weight_decay=args.weight_decay,
+        )
+        scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
+            optimizer, verbose=True, patience=5
+        )
         train_loader, val_loader = create_dataloader()
         lr = args.lr
         for epoch in range(args.start_epoch, args.epochs):
@@ -431,28 +470,16 @@ def train(train_loader, epoch, model, optimizer, criterion, args):
     return losses.avg, acces.avg, predictions, mse.avg, mse_jump.avg
 
 
-def validate(val_loader, epoch, model, criterion, args, save_path=False):
-    # keeping statistics
-    batch_time = AverageMeter()
-    data_time = AverageMeter()
-    losses = AverageMeter()
-    acces = AverageMeter()
-
-    mse = AverageMeter()
-    mse_hip = AverageMeter()
-    mse_coxa = AverageMeter()
-    mse_femur = AverageMeter()
-    mse_tibia = AverageMeter()
-    mse_tarsus = AverageMeter()
-    mse_jump = AverageMeter()
-    avg_local_max = AverageMeter()
-
-    # predictions and score maps
+def _create_heatmap_store(dataset, args, save_path):
+    """
+    Arrays the predictions and the heatmaps of dataset are written to.
+    Heatmaps are memory-mapped next to the images of save_path, None if save_path is None.
+    """
     num_cameras = 7
     predictions = np.zeros(
         shape=(
             num_cameras + 1,
-            val_loader.dataset.greatest_image_id() + 1,
+            dataset.greatest_image_id() + 1,
             config["num_predict"],
             2,
         ),
@@ -460,9 +487,8 @@ def validate(val_loader, epoch, model, criterion, args, save_path=False):
     )  # num_cameras+1 for the mirrored camera 3
     getLogger('df3d').debug("Predictions shape {}".format(predictions.shape))
 
+    score_map_arr = None
     if save_path is not None:
-        print("SAVE_PATH:")
-        print(save_path)
         unlabeled_folder_replace = save_path.replace("/", "-")
         # score_map_filename = os.path.join(args.data_folder, "./heatmap_{}.pkl".format(unlabeled_folder_replace))
         score_map_filename = os.path.join(
@@ -473,21 +499,154 @@ def validate(val_loader, epoch, model, criterion, args, save_path=False):
         )
         score_map_path = Path(score_map_filename)
         score_map_path.parent.mkdir(exist_ok=True, parents=True)
-        score_map_arr = np.memmap(
+        score_map_arr = create_heatmap(
             score_map_filename,
-            dtype="float32",
-            mode="w+",
             shape=(
                 num_cameras + 1,
-                val_loader.dataset.greatest_image_id() + 1,
+                dataset.greatest_image_id() + 1,
                 config["num_predict"],
                 args.hm_res[0],
                 args.hm_res[1],
             ),
+            dtype=config["heatmap_dtype"],
         )  # num_cameras+1 for the mirrored camera 3
+    return predictions, score_map_arr
+
+
+def _write_batch(predictions, score_map_arr, score_map, meta, args):
+    """Decodes a batch of heatmaps and writes them with their predictions, in one indexed write each"""
+    cam_read_id = to_numpy(meta["cam_read_id"])
+    img_id = to_numpy(meta["pid"])
+    pred = to_numpy(decode_heatmaps(score_map, subpixel=args.subpixel))
+    smap = to_numpy(score_map.cpu())
+    # mirrored cameras are saved flipped back
+    flip = np.isin(to_numpy(meta["cid"]), config["flip_cameras"])
+    if np.any(flip):
+        smap = smap.copy()
+        smap[flip] = smap[flip, :, :, ::-1]
+        pred[flip, :, 0] = 1 - pred[flip, :, 0]
+    score_map_arr[cam_read_id, img_id, :] = smap
+    predictions[cam_read_id, img_id, :] = pred
+
+
+def _forward(model, inputs, args, device, stacks_run):
+    """Runs the network on a batch without gradients, returns the outputs of the stacks that were run"""
+    # early exit, exported networks have the number of stacks fixed at export time
+    forward_kwargs = dict()
+    if not args.exported:
+        forward_kwargs = dict(num_stacks=args.exit_stack, peak_tol=args.exit_tol)
+        # DataParallel replicas would stop at different stacks and their outputs could not be gathered
+        if isinstance(model, torch.nn.DataParallel) and len(model.device_ids) > 1:
+            forward_kwargs["peak_tol"] = None
+
+    input_var = inputs.to(device, non_blocking=True)
+    if args.channels_last:
+        input_var = input_var.contiguous(memory_format=torch.channels_last)
+
+    with torch.inference_mode(), torch.autocast(
+        device_type=device.type, dtype=torch.bfloat16, enabled=args.precision == "bf16"
+    ):
+        output = model(input_var, **forward_kwargs)
+    stacks_run.update(len(output), inputs.size(0))
+    return output
+
+
+def predict(loader, model, args, save_path):
+    """
+    Runs the network on an unlabeled loader, built with inference=True.
+    Only the predictions and the heatmaps are computed, there are no targets, losses nor accuracies.
+    """
+    batch_time = AverageMeter()
+    data_time = AverageMeter()
+    stacks_run = AverageMeter()
+
+    predictions, score_map_arr = _create_heatmap_store(loader.dataset, args, save_path)
+
+    model.eval()
+    device = get_device(args)
+
+    end = time.time()
+    bar = Bar("Processing", max=len(loader))
+    bar.start()
+    for i, (inputs, meta) in enumerate(loader):
+        data_time.update(time.time() - end)
+
+        output = _forward(model, inputs, args, device, stacks_run)
+        score_map = output[-1].float()
+
+        if save_path is not None:
+            _write_batch(predictions, score_map_arr, score_map, meta, args)
+
+        if i < args.num_output_image:
+            drosophila_img = drosophila_image_overlay(
+                inputs,
+                score_map.cpu(),
+                args.hm_res,
+                3,
+                np.arange(config["num_predict"]),
+                img_id=int(meta["image_name"][0].split("_")[-1]),
+            )
+
+            template = "{}_overlay_val_epoch_{}_{}_{:06d}_{}.jpg"
+
+            folder_name = meta["folder_name"][0]
+            folder_name = (
+                folder_name.replace(" ", "_").replace("\\", "-").replace("/", "-")
+            )
+            save_image_name = template.format(
+                "left" if meta["cid"][0] == 0 else "right",
+                0,
+                folder_name,
+                meta["pid"][0],
+                meta["cid"][0],
+            )
+
+            save_image_name = save_image_name.replace(" ", "_ ").replace("\\", "-")
+            save_image(
+                img_path=os.path.join(args.checkpoint_image_dir, save_image_name),
+                img=drosophila_img,
+            )
+
+        batch_time.update(time.time() - end)
+        end = time.time()
+
+        bar.suffix = "({batch}/{size}) D:{data:.6f}s|B:{bt:.3f}s".format(
+            batch=i + 1,
+            size=len(loader),
+            data=data_time.val,
+            bt=batch_time.val,
+        )
+        bar.next()
+
+    bar.finish()
+    getLogger('df3d').debug("Average number of stacks run: {:.2f}".format(stacks_run.avg))
+    if score_map_arr is not None:
+        score_map_arr.flush()
+    return predictions, score_map_arr
+
+
+def validate(val_loader, epoch, model, criterion, args, save_path=False):
+    # keeping statistics
+    batch_time = AverageMeter()
+    data_time = AverageMeter()
+    losses = AverageMeter()
+    acces = AverageMeter()
+
+    mse = AverageMeter()
+    mse_hip = AverageMeter()
+    mse_coxa = AverageMeter()
+    mse_femur = AverageMeter()
+    mse_tibia = AverageMeter()
+    mse_tarsus = AverageMeter()
+    mse_jump = AverageMeter()
+    avg_local_max = AverageMeter()
+
+    predictions, score_map_arr = _create_heatmap_store(val_loader.dataset, args, save_path)
 
     # switch to evaluate mode
     model.eval()
+    device = get_device(args)
+    stacks_run = AverageMeter()
 
     end = time.time()
     bar = Bar("Processing", max=len(val_loader)) #if logging.getLogger('df3d').isEnabledFor(logging.INFO) else NoOutputBar()
@@ -496,32 +655,19 @@ def validate(val_loader, epoch, model, criterion, args, save_path=False):
         # measure data loading time
         data_time.update(time.time() - end)
 
-        target = target.cuda(non_blocking=True)
-        input_var = torch.autograd.Variable(inputs.cuda())
-        target_var = torch.autograd.Variable(target)
-
         # compute output
-        with torch.no_grad():
-            output = model(input_var)
-        score_map = output[-1].data.cpu()
+        output = _forward(model, inputs, args, device, stacks_run)
+        score_map = output[-1].float().cpu()
 
         # loss = criterion(output[-1], target_var)
-        acc = accuracy(score_map.cpu(), target.cpu(), args.acc_joints)
 
         # generate predictions
         if save_path is not None:
-            for n, cam_id, cam_read_id, img_id in zip(
-                range(score_map.size(0)), meta["cid"], meta["cam_read_id"], meta["pid"]
-            ):
-                smap = to_numpy(score_map[n, :, :, :])
-                score_map_arr[cam_read_id, img_id, :] = smap
-                pr = Camera.hm_to_pred(
-                    score_map_arr[cam_read_id, img_id, :], threshold_abs=0.0
-                )
-                predictions[cam_read_id, img_id, :] = pr
+            _write_batch(predictions, score_map_arr, output[-1].float(), meta, args)
 
         # measure accuracy and record loss
-        mse_err = mse_acc(target_var.data.cpu(), score_map)
+        acc = accuracy(score_map, target, args.acc_joints)
+        mse_err = mse_acc(target, score_map)
         mse.update(torch.mean(mse_err[args.acc_joints, :]), inputs.size(0))
         mse_hip.update(
             torch.mean(mse_err[np.arange(0, mse_err.shape[0], 5), :]), inputs.size(0)
@@ -547,37 +693,7 @@ def validate(val_loader, epoch, model, criterion, args, save_path=False):
             inputs.size(0),
         )
 
-        if args.unlabeled and i < args.num_output_image:
-            drosophila_img = drosophila_image_overlay(
-                inputs,
-                score_map,
-                args.hm_res,
-                3,
-                np.arange(config["num_predict"]),
-                img_id=int(meta["image_name"][0].split("_")[-1]),
-            )
-
-            template = "{}_overlay_val_epoch_{}_{}_{:06d}_{}.jpg"
-
-            folder_name = meta["folder_name"][0]
-            folder_name = (
-                folder_name.replace(" ", "_").replace("\\", "-").replace("/", "-")
-            )
-            save_image_name = template.format(
-                "left" if meta["cid"][0] == 0 else "right",
-                epoch,
-                folder_name,
-                meta["pid"][0],
-                meta["cid"][0],
-            )
-
-            save_image_name = save_image_name.replace(" ", "_ ").replace("\\", "-")
-            save_image(
-                img_path=os.path.join(args.checkpoint_image_dir, save_image_name),
-                img=drosophila_img,
-            )
-
-        elif i < args.num_output_image:
+        if i < args.num_output_image:
             drosophila_img = drosophila_image_overlay(
                 inputs, score_map, args.hm_res, 3, np.arange(config["num_predict"])
             )
@@ -620,10 +736,9 @@ def validate(val_loader, epoch, model, criterion, args, save_path=False):
         bar.next()
 
     bar.finish()
-    if save_path is not None:
+    getLogger('df3d').debug("Average number of stacks run: {:.2f}".format(stacks_run.avg))
+    if score_map_arr is not None:
         score_map_arr.flush()
-    else:
-        score_map_arr = None
     return losses.avg, acces.avg, predictions, score_map_arr, mse.avg, mse_jump.avg
 
 
@@ -0,0 +1,97 @@
+"""
+Inference-only artifacts of the pose2d network.
+
+The exported network takes the resized image in [0, 1] and subtracts the dataset mean itself,
+as color_normalize does, so that running it does not need the training checkpoint nor the mean file.
+Shapes of the network are written next to the artifact, in <path>.json.
+"""
+import json
+
+import numpy as np
+import torch
+
+
+class NormalizedModel(torch.nn.Module):
+    """
+    Subtracts the mean from the input and returns the heatmaps of the last stack only.
+    If num_stacks is set, only the first num_stacks stacks are run.
+    """
+
+    def __init__(self, model, mean, num_stacks=None):
+        super(NormalizedModel, self).__init__()
+        self.model = model
+        self.num_stacks = num_stacks
+        self.register_buffer(
+            "mean", torch.as_tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        )
+
+    def forward(self, x):
+        return (self.model(x - self.mean, num_stacks=self.num_stacks)[-1],)
+
+
+class OnnxModel:
+    """Runs an exported onnx network with onnxruntime, called like the torch module"""
+
+    def __init__(self, path, device):
+        import onnxruntime
+
+        providers = ["CPUExecutionProvider"]
+        if device.type == "cuda":
+            providers.insert(0, "CUDAExecutionProvider")
+        self.session = onnxruntime.InferenceSession(path, providers=providers)
+        self.device = device
+
+    def eval(self):
+        return self
+
+    def __call__(self, x):
+        out = self.session.run(None, {"image": np.ascontiguousarray(x.cpu().numpy())})
+        return (torch.from_numpy(out[0]).to(self.device),)
+
+
+def meta_path(path):
+    return path + ".json"
+
+
+def export_model(model, mean, path, meta, fmt="torchscript"):
+    """
+    Writes the network as a frozen torchscript module or as an onnx graph.
+    meta holds image_shape, heatmap_shape, num_classes and num_stacks, the number of stacks to run.
+    """
+    if isinstance(model, torch.nn.DataParallel):
+        model = model.module
+    model = NormalizedModel(model.cpu(), mean, meta["num_stacks"]).eval()
+    example = torch.zeros(1, 3, meta["image_shape"][0], meta["image_shape"][1])
+
+    with torch.no_grad():
+        if fmt == "torchscript":
+            traced = torch.jit.freeze(torch.jit.trace(model, example))
+            traced.save(path)
+        elif fmt == "onnx":
+            torch.onnx.export(
+                model,
+                example,
+                path,
+                input_names=["image"],
+                output_names=["heatmap"],
+                dynamic_axes={"image": {0: "batch"}, "heatmap": {0: "batch"}},
+                opset_version=11,
+            )
+        else:
+            raise NotImplementedError("Unknown export format {}".format(fmt))
+
+    meta = dict(meta, format=fmt)
+    with open(meta_path(path), "w") as f:
+        json.dump(meta, f)
+    return meta
+
+
+def load_exported(path, device=torch.device("cpu")):
+    """Returns the exported network and its meta data"""
+    with open(meta_path(path), "r") as f:
+        meta = json.load(f)
+    if meta["format"] == "onnx":
+        model = OnnxModel(path, device)
+    else:
+        model = torch.jit.load(path, map_location=device)
+    return model, meta
@@ -3,6 +3,7 @@ Hourglass network inserted in the pre-activated Resnet
 Use lr=0.01 for current version
 (c) YANG, Wei 
 '''
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -154,7 +155,27 @@ class HourglassNet(nn.Module):
                 self.relu,
             )
 
-    def forward(self, x):
+    @staticmethod
+    def _peaks_converged(prev, score, peak_tol):
+        """Whether the heatmap peaks of two stacks are at most peak_tol pixels apart, for every joint"""
+        w = score.size(-1)
+        prev_peak = prev.flatten(2).argmax(dim=2)
+        peak = score.flatten(2).argmax(dim=2)
+        dist_r = (torch.div(prev_peak, w, rounding_mode="floor") - torch.div(peak, w, rounding_mode="floor")).abs()
+        dist_c = (prev_peak % w - peak % w).abs()
+        return bool(torch.all(torch.max(dist_r, dist_c) <= peak_tol))
+
+    def forward(self, x, num_stacks=None, peak_tol=None):
+        """
+        num_stacks: run only the first num_stacks stacks, all of them by default
+        peak_tol: stop earlier once the heatmap peaks of two consecutive stacks
+                  are at most peak_tol heatmap pixels apart. This is decided for the whole batch,
+                  so the result of an image depends on the images it is batched with.
+                  Not supported under nn.DataParallel with several devices, whose replicas
+                  could stop at different stacks.
+        returns the heatmaps of every stack that was run
+        """
+        num_stacks = self.num_stacks if num_stacks is None else min(num_stacks, self.num_stacks)
         out = []
         x = self.conv1(x)
         x = self.bn1(x)
@@ -165,13 +186,15 @@ class HourglassNet(nn.Module):
         x = self.layer2(x)  
         x = self.layer3(x)  
 
-        for i in range(self.num_stacks):
+        for i in range(num_stacks):
             y = self.hg[i](x)
             y = self.res[i](y)
             y = self.fc[i](y)
             score = self.score[i](y)
             out.append(score)
-            if i < self.num_stacks-1:
+            if peak_tol is not None and i > 0 and self._peaks_converged(out[-2], score, peak_tol):
+                break
+            if i < num_stacks-1:
                 fc_ = self.fc_[i](y)
                 score_ = self.score_[i](score)
                 x = x + fc_ + score_
@@ -6,7 +6,7 @@ import math
 from .misc import *
 import numpy as np
 
-__all__ = ['accuracy', 'AverageMeter', 'mse_acc']
+__all__ = ['accuracy', 'AverageMeter', 'mse_acc', 'decode_heatmaps']
 
 def get_preds(scores):
     ''' get predictions from score maps in torch Tensor
@@ -28,6 +28,31 @@ def get_preds(scores):
     return preds
 
 
+def decode_heatmaps(scores, subpixel=False):
+    ''' keypoints of a batch of score maps, on the device of the score maps
+        same as calling Camera.hm_to_pred(hm, threshold_abs=0.0) on every heatmap,
+        if subpixel, peaks are moved by a quarter pixel towards the higher neighbour as in final_preds
+        return type: torch.FloatTensor, BxJx2, (x / width, y / height), zero for non-positive heatmaps
+    '''
+    assert scores.dim() == 4, 'Score maps should be 4-dim'
+    h, w = scores.size(2), scores.size(3)
+    flat = scores.flatten(2)
+    maxval, idx = torch.max(flat, 2)
+
+    preds = torch.stack([idx % w, torch.div(idx, w, rounding_mode='floor')], dim=2).float()
+    if subpixel:
+        px, py = idx % w, torch.div(idx, w, rounding_mode='floor')
+        left = flat.gather(2, (idx - (px > 0).long()).unsqueeze(2)).squeeze(2)
+        right = flat.gather(2, (idx + (px < w - 1).long()).unsqueeze(2)).squeeze(2)
+        up = flat.gather(2, (idx - w * (py > 0).long()).unsqueeze(2)).squeeze(2)
+        down = flat.gather(2, (idx + w * (py < h - 1).long()).unsqueeze(2)).squeeze(2)
+        preds += torch.stack([(right - left).sign(), (down - up).sign()], dim=2) * .25
+
+    preds /= torch.tensor([w, h], dtype=preds.dtype, device=preds.device)
+    preds *= maxval.gt(0).unsqueeze(2).to(preds.dtype)
+    return preds
+
+
 def get_local_maxima(scores, min_distance=2, threshold_rel=0.05, num_peaks=10):
     assert scores.dim() == 4, 'Score maps should be 4-dim'
     scores_np = to_numpy(scores)
@@ -38,6 +38,31 @@ def load_image(img_path):
     return im_to_torch(im)
 
 
+def load_image_resized(img_path, img_res, flip=False):
+    """
+    Decodes the image with opencv and resizes it to img_res (H x W) as the training images,
+    returns the C x H x W tensor im_to_torch(scipy.misc.imresize(load_image(img_path), img_res)).
+    When the image is at least twice as large as img_res, it is decoded at a reduced size first,
+    which then only approximates the training images.
+    """
+    flags = cv2.IMREAD_COLOR
+    width, height = config["image_shape"]
+    for factor, reduced in ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                            (4, cv2.IMREAD_REDUCED_COLOR_4),
+                            (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if height // factor >= img_res[0] and width // factor >= img_res[1]:
+            flags = reduced
+            break
+    im = cv2.imread(img_path, flags)
+    if im is None:
+        raise FileNotFoundError(img_path)
+    im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+    if flip:
+        im = im[:, ::-1]
+    # same PIL bilinear resampling and contrast stretch of the float image as the training images
+    return im_to_torch(scipy.misc.imresize(im_to_torch(np.ascontiguousarray(im)), img_res))
+
+
 def save_image(img_path, img):
     scipy.misc.imsave(img_path, img)
 
@@ -20,28 +20,32 @@ def apply_transformation(pts, R=None, t=None, s=None, tform=None):
 
 def calc_bone_length(pts3d, warn=False):
     '''
-    Returns the distances of adjacent points inside pts3d
+    Returns the distances of adjacent points inside pts3d,
+    a ... x n_points x 3 array gives a ... x n_points - 1 array
     '''
-    n_points = pts3d.shape[0]
-    bone_length = np.zeros((n_points - 1))
-    for idx in range(n_points - 1):
-        bone_length[idx] = np.linalg.norm((pts3d[idx + 1] - pts3d[idx]))
+    bone_length = np.linalg.norm(np.diff(pts3d, axis=-2), axis=-1)
     if warn:
-        if np.any(bone_length[0] > bone_length[1:]):
+        if np.any(bone_length[..., :1] > bone_length[..., 1:]):
             warnings.warn("Coxa-femur is longer than other segments {}".format(bone_length))
 
     return bone_length
 
 
+# template path -> (modification time, points3d), templates are read once per modification
+_template_cache = dict()
+
+
 def read_template_pose3d(path=config["procrustes_template"]):
-    if os.path.isfile(path):
+    if not os.path.isfile(path):
+        path = glob.glob(os.path.join(path, 'pose_result*.pkl'))[0]
+    mtime = os.path.getmtime(path)
+    if path not in _template_cache or _template_cache[path][0] != mtime:
         d = np.load(file=path, allow_pickle=True)
-    else:
-        d = np.load(file=glob.glob(os.path.join(path, 'pose_result*.pkl'))[0], allow_pickle=True)
+        pts3d = d["points3d"]
+        assert (pts3d is not None)
+        _template_cache[path] = (mtime, np.asarray(pts3d))
 
-    pts3d = d["points3d"]
-    assert (pts3d is not None)
-    return pts3d
+    return _template_cache[path][1].copy()
 
 
 def procrustes_seperate(pts, reflection='best', verbose=False,
@@ -50,15 +54,16 @@ def procrustes_seperate(pts, reflection='best', verbose=False,
     Performs procrustes seperately for each three legs seperately
     '''
 
+    template = read_template_pose3d()
     m_left = np.arange(0, 15)
-    points3d_gt_left = read_template_pose3d()[:, m_left].copy()
+    points3d_gt_left = template[:, m_left].copy()
     points3d_pred_left = pts[:, m_left].copy()
     pts_t_left = procrustes(pts=points3d_pred_left, template=points3d_gt_left, joint=joint, verbose=verbose,
                             reflection=reflection,
                             return_transf=False)
 
     m_right = np.arange(skeleton.num_joints // 2, skeleton.num_joints // 2 + 15)
-    points3d_gt_right = read_template_pose3d()[:, m_right].copy()
+    points3d_gt_right = template[:, m_right].copy()
     points3d_pred_right = pts[:, m_right].copy()
     pts_t_right, tform = procrustes(pts=points3d_pred_right, template=points3d_gt_right, joint=joint, verbose=verbose,
                                     reflection=reflection,
@@ -80,14 +85,9 @@ def procrustes(pts, template=None, reflection='best', verbose=False,
 
     # calculate the scaling factor
     n_limbs = 3
-    bone_length_pts = np.zeros((pts.shape[0], n_limbs, 4))
-    for img_id in range(pts.shape[0]):
-        for limb_id in range(n_limbs):
-            bone_length_pts[img_id, limb_id, :] = calc_bone_length(pts[img_id, 5 * limb_id:5 * (limb_id + 1)])
-    bone_length_template = np.zeros((template.shape[0], n_limbs, 4))
-    for img_id in range(template.shape[0]):
-        for limb_id in range(n_limbs):
-            bone_length_template[img_id, limb_id, :] = calc_bone_length(template[img_id, 5 * limb_id:5 * (limb_id + 1)])
+    bone_length_pts = calc_bone_length(pts[:, :5 * n_limbs].reshape(pts.shape[0], n_limbs, 5, -1))
+    bone_length_template = calc_bone_length(
+        template[:, :5 * n_limbs].reshape(template.shape[0], n_limbs, 5, -1))
     s = np.median(bone_length_template.reshape(bone_length_template.shape[0], -1), axis=0) / np.median(
         bone_length_pts.reshape(bone_length_pts.shape[0], -1), axis=0)
     s = np.median(s)